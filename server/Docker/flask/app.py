@@ -1,9 +1,13 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 # from flask_cors import CORS
 import traceback
 import time
+import json
+import struct
+import base64
+import hashlib
 from pymongo import MongoClient
 from bson import ObjectId
 import os
@@ -13,9 +17,15 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import psutil
 import gc
+import threading
+import tempfile
 
-from codebert_analyzer import CodeBERTAnalyzer, SnippetInfo
-from structural_analysis import StructuralAnalysis
+from codebert_analyzer import CodeBERTAnalyzer, SnippetInfo, pack_upper_triangle
+from line_projection import check_structure_options
+from structural_analysis import RENDER_FORMATS, StructuralAnalysis, structure_key
+from similarity_cache import MatrixStateCache, ResultCache, SharedStore, SingleFlight
+from similarity_jobs import SimilarityJobManager
+from werkzeug.datastructures import MultiDict
 
 
 # Replace with a global variable
@@ -82,7 +92,8 @@ limiter = Limiter(
 # Connect to the MongoDB server
 MONGO_URI = os.getenv("MONGO_URI")
 # print("Connecting to MongoDB server at:", MONGO_URI)
-client = MongoClient(MONGO_URI)
+# connect=False defers connecting until first use, i.e. after a gunicorn fork
+client = MongoClient(MONGO_URI, connect=False)
 db = client["codec"]
 userSubmissionsCollection = db["usersubmissions"]
 snapshotsCollection = db["codesnapshots"]
@@ -91,6 +102,50 @@ snapshotsCollection = db["codesnapshots"]
 logger.info("Initializing CodeBERT model...")
 codebert_detector = None
 
+# Last matrix per query, so refreshes only score new or changed submissions
+matrix_states = MatrixStateCache(int(os.getenv("MATRIX_STATE_CACHE_SIZE", 32)))
+
+# Finished matrix responses keyed by query and submission-set fingerprint,
+# shared by identical concurrent or repeated queries
+matrix_flight = SingleFlight()
+matrix_results = ResultCache(
+    float(os.getenv("MATRIX_RESULT_TTL_SECONDS", 3600)),
+    int(os.getenv("MATRIX_RESULT_CACHE_SIZE", 64)),
+    int(os.getenv("MATRIX_RESULT_CACHE_MB", 256)) * 1024 * 1024,
+)
+
+# SQLite file holding the state every worker has to see: matrix jobs and
+# structure analyses. gunicorn.conf.py points all workers at one file.
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH") or os.path.join(
+    tempfile.mkdtemp(prefix="codebert-state-"), "state.sqlite3"
+)
+
+# Structure analyses keyed by the content hash of the snippet pair, shared
+# between workers, and their rendered images keyed by (hash, DPI, format),
+# drawn again by each worker that serves them
+structure_flight = SingleFlight()
+structure_results = SharedStore(
+    SHARED_STATE_PATH,
+    "structure_results",
+    float(os.getenv("STRUCTURE_RESULT_TTL_SECONDS", 3600)),
+    int(os.getenv("STRUCTURE_RESULT_CACHE_SIZE", 256)),
+)
+structure_images = ResultCache(
+    float(os.getenv("STRUCTURE_RESULT_TTL_SECONDS", 3600)),
+    int(os.getenv("STRUCTURE_IMAGE_CACHE_SIZE", 64)),
+    int(os.getenv("STRUCTURE_IMAGE_CACHE_MB", 128)) * 1024 * 1024,
+)
+
+# Background matrix jobs for rooms too large to answer within one request
+matrix_jobs = SimilarityJobManager(
+    SharedStore(
+        SHARED_STATE_PATH,
+        "matrix_jobs",
+        float(os.getenv("MATRIX_JOB_TTL_SECONDS", 600)),
+    ),
+    int(os.getenv("MATRIX_JOB_WORKERS", 2)),
+)
+
 
 def get_codebert():
     global codebert_detector
@@ -103,6 +158,90 @@ def get_codebert():
     return codebert_detector
 
 
+def load_models():
+    """Load the CodeBERT weights now instead of on the first request.
+
+    Called by gunicorn.conf.py in the master process before workers fork.
+    """
+    log_memory_usage("BEFORE MODEL PRELOAD")
+    get_codebert()._ensure_model_loaded()
+    structural = get_structural_detector()
+    structural._ensure_analyzer_loaded()
+    structural.analyzer._ensure_model_loaded()
+    log_memory_usage("AFTER MODEL PRELOAD")
+
+
+# Optional warmup: load the models and run them once (including UMAP's numba
+# compilation when it is the projection engine) before /ready reports the
+# instance as routable
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "false").lower() == "true"
+readiness = {"ready": not WARMUP_ON_START, "error": None, "seconds": None}
+
+
+def warmup():
+    """Warm up the detectors and mark the instance ready when done."""
+    start_time = time.time()
+    try:
+        load_models()
+        get_codebert().calculate_similarity("int x = 0;", "int y = 1;")
+        get_structural_detector().warmup()
+        gc.collect()
+        readiness["seconds"] = round(time.time() - start_time, 2)
+        readiness["ready"] = True
+        mark_worker_ready()
+        logger.info(f"Warmup completed in {readiness['seconds']} seconds")
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        logger.error(f"Error during warmup: {str(e)}\n{tb_str}")
+        readiness["error"] = str(e)
+
+
+def start_warmup():
+    """Run warmup in the background so /health and /ready answer meanwhile."""
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+def mark_worker_ready():
+    """Record that this worker is ready to serve.
+
+    Under gunicorn.conf.py every worker leaves a marker file named after its
+    pid in WARMUP_MARKER_DIR, so /ready can wait for all of them rather than
+    only the one that answered the probe. A no-op for ``python app.py``.
+    """
+    marker_dir = os.getenv("WARMUP_MARKER_DIR")
+    if marker_dir:
+        open(os.path.join(marker_dir, str(os.getpid())), "w").close()
+
+
+def count_pending_workers():
+    """Number of gunicorn workers that have not finished their warmup yet."""
+    marker_dir = os.getenv("WARMUP_MARKER_DIR")
+    if not marker_dir:
+        return 0
+    expected = int(os.getenv("WARMUP_WORKER_COUNT", 1))
+    return max(0, expected - len(os.listdir(marker_dir)))
+
+
+def get_embedding_cache_stats():
+    """Collect embedding cache counters from whichever detectors are loaded."""
+    stats = {}
+    if codebert_detector is not None:
+        stats["codebert"] = codebert_detector.embedding_cache.stats()
+    if structural_detector is not None and structural_detector.analyzer is not None:
+        stats["structural"] = structural_detector.analyzer.embedding_cache.stats()
+    return stats
+
+
+def get_tokenization_stats():
+    """Cumulative truncation and padding counters of the loaded detectors."""
+    stats = {}
+    if codebert_detector is not None:
+        stats["codebert"] = codebert_detector.tokenization_stats.to_dict()
+    if structural_detector is not None and structural_detector.analyzer is not None:
+        stats["structural"] = structural_detector.analyzer.tokenization_stats.to_dict()
+    return stats
+
+
 def compute_similarity_matrix_batched(snippets, batch_size=10):
     n = len(snippets)
     result_matrix = [[0 for _ in range(n)] for _ in range(n)]
@@ -129,6 +268,13 @@ def compute_similarity_matrix_batched(snippets, batch_size=10):
     return result_matrix, snippets
 
 
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ValueError("expected a positive integer")
+    return number
+
+
 @app.route("/health", methods=["GET"])
 @limiter.limit("100 per minute")
 def health_check():
@@ -139,128 +285,426 @@ def health_check():
             "status": "ok",
             "message": "Service is running",
             "memory_usage_mb": f"{memory_mb:.2f}",
+            "embedding_cache": get_embedding_cache_stats(),
+            "tokenization": get_tokenization_stats(),
+            "matrix_results": matrix_results.stats(),
+            "structure_results": structure_results.stats(),
+            "structure_images": structure_images.stats(),
         }
     )
 
 
-@app.route("/api/similarity/matrix", methods=["GET"])
-@limiter.limit("20 per minute")
-def get_similarity_matrix():
-    print("Similarity matrix request received.")
-    log_memory_usage("MATRIX START")
-    start_time = time.time()
-    try:
-        problem_id = request.args.get("problemId")
-        room_id = request.args.get("roomId")
-        verdict = request.args.get("verdict")
-        user_type = request.args.get("userType")
-        accept_partial_submissions = (
-            request.args.get("acceptPartialSubmissions") == "true"
-        )
-        highest_scoring_only = request.args.get("highestScoringOnly") == "true"
+@app.route("/ready", methods=["GET"])
+@limiter.exempt
+def readiness_check():
+    """Readiness probe: 503 until the startup warmup has finished in every worker."""
+    if readiness["ready"]:
+        pending_workers = count_pending_workers()
+        if not pending_workers:
+            return jsonify({"status": "ready", "warmup_seconds": readiness["seconds"]})
+        return jsonify({"status": "warming", "pending_workers": pending_workers}), 503
+    status = "failed" if readiness["error"] else "warming"
+    return jsonify({"status": status, "error": readiness["error"]}), 503
+
+
+def parse_matrix_filters(args):
+    """Read the submission filters of a matrix request into a normalized dict."""
+    user_type = args.get("userType") or ""
+    return {
+        "problem_id": args.get("problemId") or "",
+        "room_id": args.get("roomId") or "",
+        "verdict": args.get("verdict") or "",
+        # "All" and an empty userType both mean no filter
+        "user_type": "" if user_type == "All" else user_type,
+        "accept_partial_submissions": args.get("acceptPartialSubmissions") == "true",
+        "highest_scoring_only": args.get("highestScoringOnly") == "true",
+    }
+
+
+def parse_sparse_params(args):
+    """Read topK/minScore of a matrix request; raises ValueError when malformed."""
+    top_k = args.get("topK", type=_positive_int)
+    min_score = args.get("minScore", type=int)
+    if (top_k is None and "topK" in args) or (
+        min_score is None and "minScore" in args
+    ):
+        raise ValueError("topK must be a positive integer and minScore an integer")
+    return top_k, min_score
+
+
+def parse_include_code(args, output_format="json", sparse=False):
+    """Whether a matrix response carries every snippet's code.
+
+    Only the dense JSON and NDJSON matrices include it by default; sparse and
+    packed responses leave it out unless includeCode=true is passed.
+    """
+    dense = output_format in ("json", "ndjson") and not sparse
+    return args.get("includeCode", "true" if dense else "false") == "true"
+
+
+def matrix_cache_key(filters):
+    """Hashable key identifying the submission set selected by filters."""
+    return tuple(filters[name] for name in sorted(filters))
+
+
+def build_submission_pipeline(filters, fields=None):
+    """Aggregation pipeline selecting the submissions compared in a matrix.
+
+    With ``fields`` the documents are projected down to those fields early,
+    so the code itself never leaves the database.
+    """
+    query = {}
+
+    # Only apply verdict filter if a specific verdict is provided
+    if filters["verdict"]:  # If a specific verdict is provided (not empty string)
+        query["verdict"] = filters["verdict"]
+    # Don't set a default verdict when "All" is selected (empty string)
+
+    # If accept_partial_submissions is enabled, add score filter
+    if filters["accept_partial_submissions"]:
+        query["score"] = {"$gt": 0}
+
+    if filters["problem_id"]:
+        query["problem"] = filters["problem_id"]
+
+    if filters["room_id"]:
+        query["room"] = filters["room_id"]
+
+    if filters["user_type"]:
+        query["user_type"] = filters["user_type"]
+
+    print("query:", query)
+
+    aggregation_pipeline = [{"$match": query}]
+    if fields:
+        # score, submission_date and learner_id are still needed by the
+        # per-learner filter below
+        projection = {
+            field: 1 for field in ("score", "submission_date", "learner_id", *fields)
+        }
+        aggregation_pipeline.append({"$project": projection})
+
+    # Apply highest-scoring filter per learner if enabled
+    if filters["highest_scoring_only"]:
+        aggregation_pipeline += [
+            # Sort by score descending. Ties (several full-score submissions)
+            # are broken by date and id so every query picks the same document
+            {"$sort": {"score": -1, "submission_date": -1, "_id": 1}},
+            {"$group": {"_id": "$learner_id", "doc": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$doc"}},
+        ]
+    return aggregation_pipeline
 
-        if not problem_id and not room_id:
-            return (
-                jsonify(
-                    {"success": False, "message": "No problemId or roomId provided"}
-                ),
-                400,
-            )
 
-        query = {}
+def submission_fingerprint(versions):
+    """Digest of (submission id, submission date) pairs.
 
-        # Only apply verdict filter if a specific verdict is provided
-        if verdict:  # If a specific verdict is provided (not empty string)
-            query["verdict"] = verdict
-        # Don't set a default verdict when "All" is selected (empty string)
+    The pairs are sorted first: the ``$group`` stage of highestScoringOnly
+    returns documents in no fixed order, and the same submissions must
+    always give the same ETag and cache key.
+    """
+    digest = hashlib.sha256()
+    for submission_id, submitted_at in sorted(versions):
+        digest.update(f"{submission_id}:{submitted_at}\n".encode("utf-8"))
+    return digest.hexdigest()
 
-        # If accept_partial_submissions is enabled, add score filter
-        if accept_partial_submissions:
-            query["score"] = {"$gt": 0}
 
-        if problem_id:
-            query["problem"] = problem_id
+def fetch_submission_fingerprint(filters):
+    """Fingerprint the submission set of filters with an id/date-only query."""
+    submissions = userSubmissionsCollection.aggregate(
+        build_submission_pipeline(filters, fields=("submission_date",))
+    )
+    # Submissions are insert-only, so id plus date identifies their content
+    return submission_fingerprint(
+        (str(submission["_id"]), str(submission.get("submission_date", "")))
+        for submission in submissions
+    )
 
-        if room_id:
-            query["room"] = room_id
 
-        if user_type and user_type != "All":
-            query["user_type"] = user_type
+def matrix_etag(result_key, fingerprint):
+    return hashlib.sha256(f"{result_key!r}:{fingerprint}".encode("utf-8")).hexdigest()[:32]
 
-        print("query:", query)
-        log_memory_usage("BEFORE DB QUERY")
 
-        aggregation_pipeline = [{"$match": query}]
+def fetch_matrix_snippets(filters):
+    """Load the submissions selected by filters as SnippetInfo objects."""
+    log_memory_usage("BEFORE DB QUERY")
+    submissions = list(
+        userSubmissionsCollection.aggregate(build_submission_pipeline(filters))
+    )
+    log_memory_usage(f"AFTER DB QUERY - {len(submissions)} submissions")
+
+    for submission in submissions:
+        submission["_id"] = str(submission["_id"])
+        submission["learner_id"] = str(submission["learner_id"])
+
+    logger.info(f"Found {len(submissions)} submissions matching the query")
+
+    snippets = [
+        SnippetInfo(
+            learner=submission["learner"],
+            learner_id=submission["learner_id"],
+            file_name=f"{submission['learner']}_{filters['problem_id'] or None}.js",
+            code=submission["code"],
+            timestamp=submission.get("submission_date", ""),
+            submission_id=submission["_id"],
+        )
+        for submission in submissions
+    ]
+    log_memory_usage(f"AFTER SNIPPETS CREATION - {len(snippets)} snippets")
 
-        # Apply highest-scoring filter per learner if enabled
-        if highest_scoring_only:
-            aggregation_pipeline += [
-                {"$sort": {"score": -1}},  # Sort by score descending
-                {"$group": {"_id": "$learner_id", "doc": {"$first": "$$ROOT"}}},
-                {"$replaceRoot": {"newRoot": "$doc"}},
-            ]
+    if snippets:
+        # Log data size before computation
+        total_code_size = sum(len(snippet.code) for snippet in snippets)
+        logger.info(
+            f"Total code size: {total_code_size} characters across {len(snippets)} snippets"
+        )
 
-        submissions = list(userSubmissionsCollection.aggregate(aggregation_pipeline))
-        log_memory_usage(f"AFTER DB QUERY - {len(submissions)} submissions")
+    # Add a size limit to prevent OOM
+    if len(snippets) > 50:
+        logger.warning(
+            f"Large number of snippets ({len(snippets)}) may cause memory issues"
+        )
+        # Consider limiting the number of snippets if needed
+        # snippets = snippets[:50]  # Uncomment to limit
 
-        for submission in submissions:
-            submission["_id"] = str(submission["_id"])
-            submission["learner_id"] = str(submission["learner_id"])
+    return snippets
 
-        logger.info(f"Found {len(submissions)} submissions matching the query")
 
-        snippets = [
-            SnippetInfo(
-                learner=submission["learner"],
-                learner_id=submission["learner_id"],
-                file_name=f"{submission['learner']}_{problem_id}.js",
-                code=submission["code"],
-                timestamp=submission.get("submission_date", ""),
-            )
-            for submission in submissions
-        ]
-        log_memory_usage(f"AFTER SNIPPETS CREATION - {len(snippets)} snippets")
+# Packed matrix transport: the strict upper triangle (diagonal is always 100)
+# in row-major order, one uint8 score per cell. format=binary sends it as
+# application/octet-stream prefixed by a 4-byte big-endian header length and
+# a JSON header; format=base64 embeds it in the usual JSON response.
+PACKED_FORMATS = ("binary", "base64")
+PACKED_MATRIX_ENCODING = "uint8-upper-triangle"
 
-        if not snippets:
-            return jsonify(
-                {
-                    "success": True,
-                    "matrix": [],
-                    "snippets": [],
-                    "message": f"No snippets found for problemId: {problem_id} or roomId: {room_id}",
-                }
-            )
 
-        # Log data size before computation
-        total_code_size = sum(len(snippet.code) for snippet in snippets)
-        logger.info(
-            f"Total code size: {total_code_size} characters across {len(snippets)} snippets"
-        )
+def score_matrix_snippets(filters, snippets, progress=None):
+    """Score snippets, reusing the rows of the last matrix computed for the same filters."""
+    detector = get_codebert()
+    matrix_key = matrix_cache_key(filters)
+    scores, state = detector.update_similarity_scores(
+        [snippet.code for snippet in snippets],
+        [snippet.submission_id for snippet in snippets],
+        matrix_states.get(matrix_key),
+        progress=progress,
+    )
+    matrix_states.put(matrix_key, state)
+    return scores, state
 
-        # Add a size limit to prevent OOM
-        if len(snippets) > 50:
-            logger.warning(
-                f"Large number of snippets ({len(snippets)}) may cause memory issues"
-            )
-            # Consider limiting the number of snippets if needed
-            # snippets = snippets[:50]  # Uncomment to limit
 
-        log_memory_usage("BEFORE MATRIX COMPUTATION")
+def stream_similarity_rows(snippets, include_code):
+    """Yield NDJSON lines: snippet metadata first, then one matrix row per line."""
+    start_time = time.time()
+    try:
         detector = get_codebert()
-        matrix, snippet_info = detector.compute_similarity_matrix(snippets)
-        log_memory_usage("AFTER MATRIX COMPUTATION")
+        snippet_info = detector.describe_snippets(snippets, include_code=include_code)
+        yield json.dumps(
+            {"type": "snippets", "size": len(snippets), "snippets": snippet_info}
+        ) + "\n"
+        del snippet_info
+
+        for index, row in detector.iter_similarity_rows(
+            [snippet.code for snippet in snippets]
+        ):
+            yield json.dumps({"type": "row", "index": index, "scores": row.tolist()}) + "\n"
 
         logger.info(
-            f"Similarity matrix computation completed in {time.time() - start_time:.2f} seconds"
+            f"Streamed similarity matrix completed in {time.time() - start_time:.2f} seconds"
         )
+        yield json.dumps({"type": "done"}) + "\n"
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        logger.error(f"Error in streamed similarity matrix: {str(e)}\n{tb_str}")
+        log_memory_usage("ERROR IN MATRIX STREAM")
+        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+
+
+def no_snippets_payload(filters):
+    return {
+        "success": True,
+        "matrix": [],
+        "snippets": [],
+        "message": f"No snippets found for problemId: {filters['problem_id'] or None} "
+        f"or roomId: {filters['room_id'] or None}",
+    }
+
+
+def compute_matrix_payload(
+    filters, output_format, include_code, top_k, min_score, progress=None
+):
+    """Compute a matrix response for a validated request.
+
+    Returns (payload, fingerprint of the submissions it covers). The payload
+    is a JSON-able dict, or the body bytes for output_format="binary".
+    ``progress`` is passed on to update_similarity_scores.
+    """
+    start_time = time.time()
+    snippets = fetch_matrix_snippets(filters)
+    fingerprint = submission_fingerprint(
+        (snippet.submission_id, str(snippet.timestamp)) for snippet in snippets
+    )
 
-        # Force garbage collection after heavy computation
-        gc.collect()
-        log_memory_usage("AFTER GARBAGE COLLECTION")
+    if not snippets:
+        return no_snippets_payload(filters), fingerprint
+
+    log_memory_usage("BEFORE MATRIX COMPUTATION")
+    detector = get_codebert()
+    scores, state = score_matrix_snippets(filters, snippets, progress)
+    snippet_info = detector.describe_snippets(snippets, include_code=include_code)
 
-        response = jsonify(
-            {"success": True, "matrix": matrix, "snippets": snippet_info}
+    if top_k is not None or min_score is not None:
+        payload = {
+            "success": True,
+            "size": len(snippets),
+            "edges": detector.similarity_edges(scores, top_k, min_score or 0),
+            "snippets": snippet_info,
+        }
+    elif output_format == "base64":
+        payload = {
+            "success": True,
+            "size": len(snippets),
+            "encoding": PACKED_MATRIX_ENCODING,
+            "matrix": base64.b64encode(pack_upper_triangle(scores)).decode("ascii"),
+            "snippets": snippet_info,
+        }
+    elif output_format == "binary":
+        header = json.dumps(
+            {
+                "size": len(snippets),
+                "encoding": PACKED_MATRIX_ENCODING,
+                "snippets": snippet_info,
+            }
+        ).encode("utf-8")
+        payload = struct.pack(">I", len(header)) + header + pack_upper_triangle(scores)
+    else:
+        payload = {"success": True, "matrix": scores.tolist(), "snippets": snippet_info}
+    log_memory_usage("AFTER MATRIX COMPUTATION")
+
+    logger.info(
+        f"Similarity matrix computation completed in {time.time() - start_time:.2f} seconds "
+        f"({state['recomputed']} of {len(snippets)} rows recomputed)"
+    )
+    return payload, fingerprint
+
+
+def build_matrix_body(filters, output_format, include_code, top_k, min_score):
+    """Compute a matrix response for a validated request.
+
+    Returns (body bytes, mimetype, fingerprint of the submissions it covers).
+    """
+    payload, fingerprint = compute_matrix_payload(
+        filters, output_format, include_code, top_k, min_score
+    )
+    if isinstance(payload, bytes):
+        result = payload, "application/octet-stream", fingerprint
+    else:
+        result = jsonify(payload).get_data(), "application/json", fingerprint
+    del payload
+
+    # Force garbage collection after heavy computation
+    gc.collect()
+    log_memory_usage("AFTER GARBAGE COLLECTION")
+    return result
+
+
+@app.route("/api/similarity/matrix", methods=["GET"])
+@limiter.limit("20 per minute")
+def get_similarity_matrix():
+    print("Similarity matrix request received.")
+    log_memory_usage("MATRIX START")
+    start_time = time.time()
+    try:
+        filters = parse_matrix_filters(request.args)
+        problem_id = filters["problem_id"] or None
+        room_id = filters["room_id"] or None
+        output_format = request.args.get("format", "json")
+
+        # Sparse output: edge list of strong pairs instead of the dense matrix
+        try:
+            top_k, min_score = parse_sparse_params(request.args)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        sparse = top_k is not None or min_score is not None
+        include_code = parse_include_code(request.args, output_format, sparse)
+
+        if not problem_id and not room_id:
+            return (
+                jsonify(
+                    {"success": False, "message": "No problemId or roomId provided"}
+                ),
+                400,
+            )
+
+        if output_format not in ("json", "ndjson") + PACKED_FORMATS:
+            return (
+                jsonify(
+                    {"success": False, "message": f"Unsupported format: {output_format}"}
+                ),
+                400,
+            )
+
+        if sparse and output_format != "json":
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "message": "topK and minScore are only supported with format=json",
+                    }
+                ),
+                400,
+            )
+
+        if output_format == "ndjson":
+            snippets = fetch_matrix_snippets(filters)
+            if not snippets:
+                return jsonify(no_snippets_payload(filters))
+            # Rows are sent as soon as each block is scored
+            return Response(
+                stream_with_context(stream_similarity_rows(snippets, include_code)),
+                mimetype="application/x-ndjson",
+            )
+
+        # A cheap id/date query tells whether the submission set changed since
+        # a cached body (or the client's copy, via If-None-Match) was built
+        result_key = (
+            matrix_cache_key(filters),
+            output_format,
+            include_code,
+            top_k,
+            min_score,
         )
+        fingerprint = fetch_submission_fingerprint(filters)
+        etag = matrix_etag(result_key, fingerprint)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        # Identical concurrent queries wait for one computation
+        result = matrix_results.get((result_key, fingerprint))
+        if result is None:
+            result, shared = matrix_flight.do(
+                result_key,
+                lambda: build_matrix_body(
+                    filters, output_format, include_code, top_k, min_score
+                ),
+            )
+            if shared:
+                logger.info("Similarity matrix shared with a concurrent request")
+            else:
+                body, _, built_fingerprint = result
+                matrix_results.put((result_key, built_fingerprint), result, len(body))
+        else:
+            logger.info("Similarity matrix served from the result cache")
+
+        body, mimetype, fingerprint = result
+        logger.info(
+            f"Similarity matrix request served in {time.time() - start_time:.2f} seconds"
+        )
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(matrix_etag(result_key, fingerprint))
+        # Let browsers keep the body but revalidate it on every use
+        response.headers["Cache-Control"] = "no-cache"
         return response
 
     except Exception as e:
@@ -280,6 +724,68 @@ def get_similarity_matrix():
         )
 
 
+def run_matrix_job(job, filters, include_code, top_k, min_score):
+    """Compute a JSON matrix response in the background, reporting progress on job."""
+    payload, _ = compute_matrix_payload(
+        filters, "json", include_code, top_k, min_score, job.report
+    )
+    logger.info(f"Similarity matrix job {job.id} completed")
+    return payload
+
+
+@app.route("/api/similarity/matrix/jobs", methods=["POST"])
+@limiter.limit("20 per minute")
+def create_similarity_matrix_job():
+    """Start (or join) a background matrix computation and return its job id."""
+    # Same parameters as GET /api/similarity/matrix, as a JSON body or query string
+    params = MultiDict(request.args)
+    for name, value in (request.get_json(silent=True) or {}).items():
+        params[name] = str(value).lower() if isinstance(value, bool) else str(value)
+
+    filters = parse_matrix_filters(params)
+    if not filters["problem_id"] and not filters["room_id"]:
+        return (
+            jsonify({"success": False, "message": "No problemId or roomId provided"}),
+            400,
+        )
+    try:
+        top_k, min_score = parse_sparse_params(params)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    include_code = parse_include_code(
+        params, sparse=top_k is not None or min_score is not None
+    )
+
+    key = (matrix_cache_key(filters), include_code, top_k, min_score)
+    job, created = matrix_jobs.submit(
+        key, lambda job: run_matrix_job(job, filters, include_code, top_k, min_score)
+    )
+    if created:
+        logger.info(f"Started similarity matrix job {job['jobId']}")
+
+    response = jsonify(
+        {
+            "success": True,
+            "jobId": job["jobId"],
+            "status": job["status"],
+            "joined": not created,
+        }
+    )
+    response.status_code = 202
+    response.headers["Location"] = f"/api/similarity/matrix/jobs/{job['jobId']}"
+    return response
+
+
+@app.route("/api/similarity/matrix/jobs/<job_id>", methods=["GET"])
+@limiter.limit("120 per minute")
+def get_similarity_matrix_job(job_id):
+    """Report a matrix job's progress, with the result once it is done."""
+    job = matrix_jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Unknown or expired job"}), 404
+    return jsonify({"success": True, **job})
+
+
 @app.route("/api/similarity/sequential", methods=["POST"])
 @limiter.limit("50 per minute")
 def get_sequential_similarity():
@@ -379,24 +885,158 @@ def get_sequential_similarity():
         )
 
 
+def parse_structure_request(data):
+    """Read code1/code2/lineMode/projection of a structure request; raises ValueError."""
+    code1 = data.get("code1", "")
+    code2 = data.get("code2", "")
+    if not code1 or not code2:
+        raise ValueError("Missing code samples")
+
+    line_mode = data.get("lineMode", "independent")
+    # Defaults to STRUCTURE_PROJECTION
+    projection = check_structure_options(line_mode, data.get("projection"))
+    return code1, code2, line_mode, projection
+
+
+def get_structure_analysis(code1, code2, line_mode, projection):
+    """Cluster result for a snippet pair, computed once per content hash."""
+    key = structure_key(code1, code2, line_mode, projection)
+    analysis = structure_results.get(key)
+    if analysis is None:
+        analysis, _ = structure_flight.do(
+            key,
+            lambda: get_structural_detector().analyze_structures(
+                code1, code2, line_mode, projection
+            ),
+        )
+        structure_results.put(key, analysis)
+    return analysis
+
+
+def get_structure_image(analysis, dpi, fmt):
+    """Rendered image of an analysis, drawn once per (content hash, DPI, format)."""
+    key = (analysis["key"], dpi, fmt)
+    image = structure_images.get(key)
+    if image is None:
+        image, _ = structure_flight.do(
+            key,
+            lambda: get_structural_detector().render_structures(analysis, dpi, fmt),
+        )
+        structure_images.put(key, image, len(image))
+    return image
+
+
+@app.route("/api/structures", methods=["POST"])
+@limiter.limit("50 per minute")
+def analyze_structures():
+    """Similar structures of two snippets as data; render them via structureId."""
+    try:
+        code1, code2, line_mode, projection = parse_structure_request(
+            request.get_json() or {}
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    try:
+        analysis = get_structure_analysis(code1, code2, line_mode, projection)
+    except ValueError as e:
+        # Snippets with no non-empty lines
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        tb_str = traceback.format_exc()
+        logger.error(f"Error in structure analysis: {str(e)}\n{tb_str}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    return jsonify(
+        {
+            "success": True,
+            "structureId": analysis["key"],
+            "overallSimilarity": analysis["overall_similarity"],
+            "structures": analysis["structures"],
+            "points": analysis["points"],
+        }
+    )
+
+
+@app.route("/api/structures/<structure_id>/image", methods=["GET"])
+@limiter.limit("100 per minute")
+def render_structures(structure_id):
+    """Draw a cached analysis; ?dpi= (50-300, default 150) and ?format=png|svg|webp."""
+    analysis = structure_results.get(structure_id)
+    if analysis is None:
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": "Unknown or expired structureId",
+                }
+            ),
+            404,
+        )
+
+    try:
+        dpi = int(request.args.get("dpi", "150"))
+    except ValueError:
+        return jsonify({"success": False, "error": "dpi must be an integer"}), 400
+    fmt = request.args.get("format", "png").lower()
+    # The 14x12 in figure is rendered as a full RGBA buffer: ~60 MB at 300 dpi
+    if not 50 <= dpi <= 300:
+        return (
+            jsonify({"success": False, "error": "dpi must be between 50 and 300"}),
+            400,
+        )
+    if fmt not in RENDER_FORMATS:
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": f"format must be one of {', '.join(RENDER_FORMATS)}",
+                }
+            ),
+            400,
+        )
+
+    etag = f"{structure_id}-{dpi}.{fmt}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    image = get_structure_image(analysis, dpi, fmt)
+    response = Response(
+        image,
+        mimetype=RENDER_FORMATS[fmt],
+        headers={"Cache-Control": "private, max-age=3600"},
+    )
+    response.set_etag(etag)
+    return response
+
+
 @app.route("/api/visualize-similarity", methods=["POST"])
 @limiter.limit("50 per minute")
 def visualize_similarity():
     log_memory_usage("VISUALIZE START")
     try:
-        data = request.get_json()
-        code1 = data.get("code1", "")
-        code2 = data.get("code2", "")
-
-        if not code1 or not code2:
-            return jsonify({"success": False, "error": "Missing code samples"}), 400
+        try:
+            code1, code2, line_mode, projection = parse_structure_request(
+                request.get_json() or {}
+            )
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
 
         print(f"Analyzing code samples: {len(code1)}, {len(code2)} chars")
         log_memory_usage("BEFORE VISUALIZATION")
 
-        # Get or initialize the structural detector
-        detector = get_structural_detector()
-        image, structures = detector.visualize_code_similarity(code1, code2)
+        # Same cached analysis and renders as /api/structures
+        try:
+            analysis = get_structure_analysis(code1, code2, line_mode, projection)
+            image = get_structure_image(analysis, 300, "png")
+            image = f"data:image/png;base64,{base64.b64encode(image).decode('utf-8')}"
+            structures = analysis["structures"]
+        except Exception as e:
+            print(f"Visualization error: {str(e)}")
+            image = get_structural_detector().render_error_image(str(e))
+            structures = []
         log_memory_usage("AFTER VISUALIZATION")
 
         # Force garbage collection
@@ -418,4 +1058,6 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
     debug_mode = os.getenv("DEBUG_MODE", "False").lower() == "true"
     logger.info(f"Starting application on port {port}, debug mode: {debug_mode}")
+    if WARMUP_ON_START:
+        start_warmup()
     app.run(host="0.0.0.0", port=port, debug=debug_mode)
@@ -0,0 +1,85 @@
+"""Production gunicorn settings for the similarity service.
+
+The app (and, with PRELOAD_MODELS, the CodeBERT weights) is loaded once in
+the master process and then forked, so every worker shares the weight pages
+copy-on-write instead of holding its own copy.
+
+    gunicorn --config gunicorn.conf.py app:app
+"""
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv("GUNICORN_WORKERS", max(1, multiprocessing.cpu_count() // 2)))
+# Threads keep background matrix jobs and micro-batching useful within a worker
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = True
+
+# Split the cores between workers so their intra-op pools do not oversubscribe
+# the CPU. Set here, before app.py imports torch or builds an ONNX session.
+torch_threads = int(
+    os.getenv("TORCH_NUM_THREADS", max(1, multiprocessing.cpu_count() // workers))
+)
+os.environ.setdefault("OMP_NUM_THREADS", str(torch_threads))
+os.environ.setdefault("ONNX_INTRA_OP_THREADS", str(torch_threads))
+
+# Each worker drops a marker here once it is warm; app.py's /ready only
+# reports ready when there is one for every worker
+os.environ["WARMUP_MARKER_DIR"] = tempfile.mkdtemp(prefix="codebert-warmup-")
+os.environ["WARMUP_WORKER_COUNT"] = str(workers)
+
+# Matrix jobs and structure analyses go to one SQLite file, so a follow-up
+# request can land on any worker
+state_dir = None
+if not os.getenv("SHARED_STATE_PATH"):
+    state_dir = tempfile.mkdtemp(prefix="codebert-state-")
+    os.environ["SHARED_STATE_PATH"] = os.path.join(state_dir, "state.sqlite3")
+
+
+def on_starting(server):
+    if os.getenv("PRELOAD_MODELS", "true").lower() != "true":
+        return
+
+    # preload_app has already imported app.py in this (master) process
+    import app
+
+    app.load_models()
+
+    # Keep the GC from touching (and so copying) the preloaded objects
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    torch.set_num_threads(torch_threads)
+    server.log.info(f"Worker {worker.pid} using {torch_threads} torch threads")
+
+
+def post_worker_init(worker):
+    # Warm up per worker: running the model or numba in the master before
+    # fork would leave the workers with broken OpenMP/threading state
+    import app
+
+    if app.WARMUP_ON_START:
+        app.start_warmup()
+    else:
+        app.mark_worker_ready()
+
+
+def child_exit(server, worker):
+    # A replacement worker has to warm up again before the instance is ready
+    marker = os.path.join(os.environ["WARMUP_MARKER_DIR"], str(worker.pid))
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ["WARMUP_MARKER_DIR"], ignore_errors=True)
+    if state_dir is not None:
+        shutil.rmtree(state_dir, ignore_errors=True)
@@ -0,0 +1,256 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class MatrixStateCache:
+    """Bounded LRU of the last similarity matrix computed for each query.
+
+    Each entry is the state returned by CodeBERTAnalyzer.update_similarity_scores,
+    so a refresh only recomputes rows for submissions that were added or changed.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._states: "OrderedDict[Hashable, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Dict]:
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+            return state
+
+    def put(self, key: Hashable, state: Dict):
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)
+
+
+class ResultCache:
+    """Bounded LRU of finished responses that expire ``ttl_seconds`` after insertion.
+
+    Entries are evicted least recently used first once there are more than
+    ``max_entries`` of them or their sizes add up to more than ``max_bytes``.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 30,
+        max_entries: int = 16,
+        max_bytes: Optional[int] = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, size: int = 0):
+        if self.ttl_seconds <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into a single execution.
+
+    The first caller runs the function; callers arriving while it runs wait
+    for it and receive the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (result, shared) where shared is True for callers that waited."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class SharedStore:
+    """JSON values in an SQLite file shared by every worker process on the host.
+
+    Entries expire ``ttl_seconds`` after they were last written; past
+    ``max_entries`` the ones closest to expiring are dropped. Each store keeps
+    its entries in its own ``table`` of the file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        table: str,
+        ttl_seconds: float = 600,
+        max_entries: Optional[int] = None,
+    ):
+        self.path = path
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Opened lazily per process: gunicorn imports the app in the master,
+        # and SQLite connections must not be carried across fork
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return this process's connection, opening it on first use."""
+        if self._pid != os.getpid():
+            # Autocommit, so put_if_absent can open its own IMMEDIATE transaction
+            self._conn = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None
+            )
+            self._pid = os.getpid()
+
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL,
+                    value TEXT NOT NULL
+                )
+                """
+            )
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = (
+                self._connection()
+                .execute(
+                    f"SELECT value FROM {self.table} WHERE key = ? AND expires_at >= ?",
+                    (key, time.time()),
+                )
+                .fetchone()
+            )
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        self._write(key, value, replace=True)
+
+    def put_if_absent(self, key: str, value: Any) -> Any:
+        """Store value unless key holds a live entry; returns whichever is stored."""
+        return self._write(key, value, replace=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection().execute(
+                f"DELETE FROM {self.table} WHERE key = ?", (key,)
+            )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            (entries,) = (
+                self._connection()
+                .execute(
+                    f"SELECT COUNT(*) FROM {self.table} WHERE expires_at >= ?",
+                    (time.time(),),
+                )
+                .fetchone()
+            )
+        return {"entries": entries}
+
+    def _write(self, key: str, value: Any, replace: bool) -> Any:
+        now = time.time()
+        data = json.dumps(value)
+        with self._lock:
+            conn = self._connection()
+            # Take the write lock before reading, so another worker cannot
+            # insert the same key between the check and the insert
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not replace:
+                    row = conn.execute(
+                        f"SELECT value FROM {self.table} WHERE key = ? AND expires_at >= ?",
+                        (key, now),
+                    ).fetchone()
+                    if row is not None:
+                        conn.execute("COMMIT")
+                        return json.loads(row[0])
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, expires_at, value) VALUES (?, ?, ?)",
+                    (key, now + self.ttl_seconds, data),
+                )
+                conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,))
+                if self.max_entries is not None:
+                    conn.execute(
+                        f"""
+                        DELETE FROM {self.table} WHERE key NOT IN (
+                            SELECT key FROM {self.table}
+                            ORDER BY expires_at DESC LIMIT ?
+                        )
+                        """,
+                        (self.max_entries,),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return value
@@ -0,0 +1,119 @@
+import hashlib
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from similarity_cache import SharedStore
+
+
+class SimilarityJob:
+    """One background matrix computation and its progress counters.
+
+    Every change is written to the shared store, where any worker can read it.
+    """
+
+    def __init__(self, key: str, store: SharedStore):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = "queued"
+        self.progress = {
+            "embeddings_done": 0,
+            "embeddings_total": 0,
+            "rows_done": 0,
+            "rows_total": 0,
+        }
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._store = store
+
+    def report(self, stage: str, done: int, total: int):
+        """Progress callback in the form expected by update_similarity_scores."""
+        self.progress[f"{stage}_done"] = done
+        self.progress[f"{stage}_total"] = total
+        self.save()
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def save(self):
+        self._store.put(f"job:{self.id}", self.to_dict())
+        if self.active:
+            # Refreshed with the job, so a job whose worker died stops
+            # claiming its key once both expire
+            self._store.put(f"active:{self.key}", self.id)
+
+    def to_dict(self) -> Dict:
+        job = {
+            "jobId": self.id,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "createdAt": self.created_at,
+            "finishedAt": self.finished_at,
+        }
+        if self.status == "done":
+            job["result"] = self.result
+        elif self.status == "failed":
+            job["error"] = self.error
+        return job
+
+
+class SimilarityJobManager:
+    """Runs matrix jobs on a small thread pool, sharing work between identical requests.
+
+    Jobs live in ``store``, so a job started by one worker process can be
+    polled through any other. Submitting a key that already has a queued or
+    running job, in any worker, returns that job instead of starting another.
+    Jobs stay available for the store's ``ttl_seconds`` after their last
+    progress report.
+    """
+
+    def __init__(self, store: SharedStore, max_workers: int = 2):
+        self._store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="similarity-job"
+        )
+
+    def submit(
+        self, key: Hashable, work: Callable[[SimilarityJob], Dict]
+    ) -> Tuple[Dict, bool]:
+        """Start ``work(job)`` for key unless one is in flight; returns (job, created)."""
+        job = SimilarityJob(self._key_digest(key), self._store)
+        # Write the job before claiming the key, so whoever finds the claim
+        # can also find the job
+        self._store.put(f"job:{job.id}", job.to_dict())
+        owner = self._store.put_if_absent(f"active:{job.key}", job.id)
+        if owner != job.id:
+            existing = self.get(owner)
+            if existing is not None:
+                self._store.delete(f"job:{job.id}")
+                return existing, False
+            # The claim outlived its job; take it over
+            self._store.put(f"active:{job.key}", job.id)
+        self._executor.submit(self._run, job, work)
+        return job.to_dict(), True
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        return self._store.get(f"job:{job_id}")
+
+    def _run(self, job: SimilarityJob, work: Callable[[SimilarityJob], Dict]):
+        job.status = "running"
+        job.save()
+        try:
+            job.result = work(job)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            job.save()
+            self._store.delete(f"active:{job.key}")
+
+    @staticmethod
+    def _key_digest(key: Hashable) -> str:
+        # repr of the query tuple is stable across processes, unlike hash()
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
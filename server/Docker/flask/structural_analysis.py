@@ -2,8 +2,7 @@ import numpy as np
 import matplotlib
 
 matplotlib.use("Agg")  # Non-interactive backend
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+from matplotlib.figure import Figure
 from scipy.spatial import ConvexHull
 import pandas as pd
 import io
@@ -11,12 +10,37 @@ import base64
 import random
 import torch
 import gc
+import hashlib
 import os
+from typing import Optional
+from line_projection import (
+    DBSCAN_EPS,
+    check_structure_options,
+    default_projection,
+    fit_pca,
+    global_projection_path,
+    linear_projection,
+    load_global_projection,
+)
 
 # Set environment variables for deterministic behavior
 os.environ["PYTHONHASHSEED"] = "42"
 os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"  # For CUDA determinism
 
+# Image formats render_structures can produce and their MIME types
+RENDER_FORMATS = {"png": "image/png", "svg": "image/svg+xml", "webp": "image/webp"}
+
+
+def structure_key(
+    code_a: str, code_b: str, line_mode: str = "independent", projection: str = "pca"
+) -> str:
+    """Content hash identifying the analysis of one pair of snippets."""
+    digest = hashlib.sha256()
+    for part in (code_a, code_b, line_mode, projection):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
 
 class StructuralAnalysis:
     def __init__(self):
@@ -30,9 +54,6 @@ class StructuralAnalysis:
         if torch.cuda.is_available():
             torch.cuda.manual_seed_all(42)
 
-        # For lazy loading
-        self._umap_reducer = None
-
     def _ensure_analyzer_loaded(self):
         """Lazy load the CodeBERT analyzer when needed."""
         if self.analyzer is None:
@@ -40,36 +61,79 @@ class StructuralAnalysis:
 
             self.analyzer = CodeBERTAnalyzer()
 
-    def _get_umap_reducer(self, n_neighbors):
-        """Lazy load the UMAP reducer."""
-        if self._umap_reducer is None:
+    def warmup(self):
+        """Run the CodeBERT encoder (and UMAP if selected) once so their first real use is fast."""
+        self._ensure_analyzer_loaded()
+        embeddings = np.array(self.get_embeddings(["int x = 0;", "return x;"]))
+        projection = default_projection()
+        if projection == "global":
+            # Only read the artifact; requests check its line mode against theirs
+            load_global_projection(global_projection_path())
+            return
+        if projection == "pca":
+            self.project_embeddings(embeddings)
+            return
+
+        # UMAP needs more points than the two warmup lines
+        self.project_embeddings(np.random.RandomState(42).rand(16, 8), "umap")
+
+    def _get_dbscan_clusterer(self, projection: str = "umap"):
+        """Create a new DBSCAN clusterer each time to avoid state issues."""
+        from sklearn.cluster import DBSCAN
+
+        return DBSCAN(
+            eps=DBSCAN_EPS[projection], min_samples=2, metric="euclidean", n_jobs=1
+        )
+
+    def project_embeddings(
+        self,
+        embeddings: np.ndarray,
+        projection: str = "pca",
+        line_mode: str = "independent",
+    ) -> np.ndarray:
+        """Reduce line embeddings, built in line_mode, to 2-D with the given engine."""
+        if projection == "umap":
+            # Force deterministic behavior for UMAP
+            torch.use_deterministic_algorithms(True)
             from umap import UMAP
 
-            self._umap_reducer = UMAP(
+            # A fresh reducer per call: fit_transform refits it, and its
+            # n_neighbors has to follow the number of lines
+            reducer = UMAP(
                 n_components=2,
-                n_neighbors=n_neighbors,
+                n_neighbors=min(6, len(embeddings) - 1),
                 min_dist=1,
                 spread=1,
                 random_state=42,
                 n_jobs=1,
             )
-        return self._umap_reducer
-
-    def _get_dbscan_clusterer(self):
-        """Create a new DBSCAN clusterer each time to avoid state issues."""
-        from sklearn.cluster import DBSCAN
+            return reducer.fit_transform(embeddings)
 
-        return DBSCAN(eps=1.2, min_samples=2, metric="euclidean", n_jobs=1)
+        if projection == "global":
+            mean, components = load_global_projection(
+                global_projection_path(), line_mode
+            )
+        else:
+            mean, components = fit_pca(embeddings)
+        return linear_projection(embeddings, mean, components)
 
-    def get_embedding(self, line):
+    def get_embedding(self, line, namespace="line"):
         # Ensure analyzer is loaded
         self._ensure_analyzer_loaded()
 
         # Use the analyzer's embedding method with preprocessing
         preprocessed_line = self.analyzer.preprocess_code(line)
-        return self.analyzer.get_embedding(preprocessed_line)
+        return self.analyzer.get_embedding(preprocessed_line, namespace)
+
+    def get_embeddings(self, lines, namespace="line"):
+        # Ensure analyzer is loaded
+        self._ensure_analyzer_loaded()
+
+        # Preprocess every line, then embed them in batched forward passes
+        preprocessed_lines = [self.analyzer.preprocess_code(line) for line in lines]
+        return self.analyzer.get_embeddings(preprocessed_lines, namespace)
 
-    def calculate_similarity(self, code1, code2):
+    def calculate_similarity(self, code1, code2, namespace="snippet"):
         # Ensure analyzer is loaded
         self._ensure_analyzer_loaded()
 
@@ -77,7 +141,7 @@ class StructuralAnalysis:
         preprocessed_code1 = self.analyzer.preprocess_code(code1)
         preprocessed_code2 = self.analyzer.preprocess_code(code2)
         return self.analyzer.calculate_similarity(
-            preprocessed_code1, preprocessed_code2
+            preprocessed_code1, preprocessed_code2, namespace
         )
 
     def infer_code_structure_type(self, code_lines: list[str]) -> str:
@@ -191,20 +255,43 @@ class StructuralAnalysis:
 
     def get_line_embeddings(self, code_snippet: str) -> tuple[np.ndarray, list[str]]:
         """Get embeddings for each non-empty line in the code snippet."""
-        lines = code_snippet.split("\n")
-        embeddings = []
-        valid_lines = []
-
-        for line in lines:
-            if not line.strip():
-                continue
-            emb = self.get_embedding(line)
-            embeddings.append(emb)
-            valid_lines.append(line)
+        valid_lines = [line for line in code_snippet.split("\n") if line.strip()]
+        embeddings = (
+            self.get_embeddings(valid_lines, namespace="line") if valid_lines else []
+        )
 
         # Convert to numpy array only at the end to avoid intermediate copies
         return np.array(embeddings), valid_lines
 
+    def get_contextual_line_embeddings(
+        self, code_snippet: str
+    ) -> tuple[np.ndarray, list[str]]:
+        """Get embeddings for each non-empty line from one pass over the whole snippet."""
+        self._ensure_analyzer_loaded()
+        return self.analyzer.get_contextual_line_embeddings(code_snippet)
+
+    def get_pair_line_embeddings(
+        self, code_a: str, code_b: str, line_mode: str = "independent"
+    ) -> tuple[np.ndarray, list[str], np.ndarray, list[str]]:
+        """Get line embeddings for two snippets with one batched embedding call.
+
+        Lines shared by both snippets (braces, ``return x;``...) are encoded
+        once; the vectors match ``get_line_embeddings`` on each snippet. In
+        "contextual" mode each snippet is instead encoded whole, once.
+        """
+        if line_mode == "contextual":
+            embeddings_a, lines_a = self.get_contextual_line_embeddings(code_a)
+            embeddings_b, lines_b = self.get_contextual_line_embeddings(code_b)
+            return embeddings_a, lines_a, embeddings_b, lines_b
+
+        lines_a = [line for line in code_a.split("\n") if line.strip()]
+        lines_b = [line for line in code_b.split("\n") if line.strip()]
+        lines = lines_a + lines_b
+        embeddings = np.array(
+            self.get_embeddings(lines, namespace="line") if lines else []
+        )
+        return embeddings[: len(lines_a)], lines_a, embeddings[len(lines_a) :], lines_b
+
     def get_line_positions(self, code: str) -> list[dict]:
         """Get the start and end positions of each line in the code."""
         positions = []
@@ -226,11 +313,21 @@ class StructuralAnalysis:
         return positions
 
     def enrich_similar_structures(
-        self, code_a: str, code_b: str, similar_structures: list[dict]
+        self,
+        code_a: str,
+        code_b: str,
+        similar_structures: list[dict],
+        line_vectors: Optional[dict] = None,
     ) -> list[dict]:
-        """Enrich similar structures with line positions and detailed similarity info."""
-        positions_a = self.get_line_positions(code_a)
-        positions_b = self.get_line_positions(code_b)
+        """Enrich similar structures with line positions and detailed similarity info.
+
+        ``line_vectors`` maps a cluster id to the embeddings of its code_a and
+        code_b lines, as computed for the projection; clusters without an
+        entry have their lines embedded here.
+        """
+        line_vectors = line_vectors or {}
+        positions_a = self._positions_by_content(code_a)
+        positions_b = self._positions_by_content(code_b)
 
         enriched_structures = []
         for structure in similar_structures:
@@ -238,34 +335,46 @@ class StructuralAnalysis:
             lines_a = structure["code_a"]
             lines_b = structure["code_b"]
 
-            # Find positions in original code
-            matched_positions_a = []
-            matched_positions_b = []
-
-            for line in lines_a:
-                for pos in positions_a:
-                    if pos["content"].strip() == line.strip():
-                        matched_positions_a.append(pos)
-
-            for line in lines_b:
-                for pos in positions_b:
-                    if pos["content"].strip() == line.strip():
-                        matched_positions_b.append(pos)
-
-            # Calculate line-by-line similarities
-            line_similarities = []
-            for line_a, pos_a in zip(lines_a, matched_positions_a):
-                line_sims = []
-                for line_b, pos_b in zip(lines_b, matched_positions_b):
-                    sim = self.calculate_similarity(line_a, line_b)
-                    line_sims.append(
-                        {
-                            "similarity": float(sim),
-                            "position_a": pos_a,
-                            "position_b": pos_b,
-                        }
-                    )
-                line_similarities.append(line_sims)
+            # Every position whose content matches, for each line in order
+            matched_positions_a = [
+                pos for line in lines_a for pos in positions_a.get(line.strip(), [])
+            ]
+            matched_positions_b = [
+                pos for line in lines_b for pos in positions_b.get(line.strip(), [])
+            ]
+
+            # Line pairs are taken in order up to the shorter of lines/positions
+            count_a = min(len(lines_a), len(matched_positions_a))
+            count_b = min(len(lines_b), len(matched_positions_b))
+            vectors = line_vectors.get(structure["cluster_id"])
+            if vectors is None:
+                vectors = (
+                    np.array(self.get_embeddings(lines_a[:count_a])),
+                    np.array(self.get_embeddings(lines_b[:count_b])),
+                )
+            vectors_a, vectors_b = vectors[0][:count_a], vectors[1][:count_b]
+
+            # Calculate line-by-line similarities in one block, accumulated in
+            # float64 like calculate_similarity
+            if count_a and count_b:
+                cosine = (
+                    vectors_a.astype(np.float64) @ vectors_b.astype(np.float64).T
+                ).astype(np.float32)
+                scores = self.analyzer._transform_similarity(cosine)
+            else:
+                scores = np.zeros((count_a, count_b), dtype=np.float32)
+
+            line_similarities = [
+                [
+                    {
+                        "similarity": float(scores[i, j]),
+                        "position_a": matched_positions_a[i],
+                        "position_b": matched_positions_b[j],
+                    }
+                    for j in range(count_b)
+                ]
+                for i in range(count_a)
+            ]
 
             enriched_structures.append(
                 {
@@ -279,300 +388,370 @@ class StructuralAnalysis:
 
         return enriched_structures
 
-    def visualize_code_similarity(
-        self, code_snippet_a: str, code_snippet_b: str, dim: int = 2
-    ) -> tuple[str, list[dict]]:
-        """Generate visualization for code similarity between two snippets with improved readability."""
-        try:
-            # Force deterministic behavior for UMAP
-            torch.use_deterministic_algorithms(True)
-
-            # Get embeddings for both snippets
-            embeddings_a, lines_a = self.get_line_embeddings(code_snippet_a)
-            embeddings_b, lines_b = self.get_line_embeddings(code_snippet_b)
-
-            if len(embeddings_a) == 0 or len(embeddings_b) == 0:
-                raise ValueError(
-                    "One or both code snippets are empty after preprocessing"
-                )
-
-            # Combine embeddings and create labels
-            combined_embeddings = np.vstack([embeddings_a, embeddings_b])
-            labels = np.concatenate(
-                [np.zeros(len(embeddings_a)), np.ones(len(embeddings_b))]
-            )
+    def _positions_by_content(self, code: str) -> dict[str, list[dict]]:
+        """Line positions of the code grouped by stripped content, in line order."""
+        positions = {}
+        for pos in self.get_line_positions(code):
+            positions.setdefault(pos["content"].strip(), []).append(pos)
+        return positions
 
-            # Calculate appropriate n_neighbors value
-            n_neighbors = min(6, len(combined_embeddings) - 1)
+    def analyze_structures(
+        self,
+        code_snippet_a: str,
+        code_snippet_b: str,
+        line_mode: str = "independent",
+        projection: Optional[str] = None,
+    ) -> dict:
+        """Cluster the lines of two snippets and describe the structures they share.
+
+        Returns the plotted points, the enriched structures and the overall
+        similarity under ``key``, the content hash of the inputs; nothing here
+        touches matplotlib, see ``render_structures``.
+        """
+        projection = check_structure_options(line_mode, projection)
+
+        # Get embeddings for both snippets
+        embeddings_a, lines_a, embeddings_b, lines_b = self.get_pair_line_embeddings(
+            code_snippet_a, code_snippet_b, line_mode
+        )
 
-            # Get UMAP reducer with appropriate parameters
-            reducer = self._get_umap_reducer(n_neighbors)
+        if len(embeddings_a) == 0 or len(embeddings_b) == 0:
+            raise ValueError("One or both code snippets are empty after preprocessing")
 
-            # Apply UMAP for dimensionality reduction
-            reduced_embeddings = reducer.fit_transform(combined_embeddings)
+        # Combine embeddings and create labels
+        combined_embeddings = np.vstack([embeddings_a, embeddings_b])
+        labels = np.concatenate(
+            [np.zeros(len(embeddings_a)), np.ones(len(embeddings_b))]
+        )
 
-            # Clear memory of original embeddings
-            del embeddings_a, embeddings_b, combined_embeddings
-            gc.collect()
+        # Reduce to 2-D with the selected projection engine
+        reduced_embeddings = self.project_embeddings(
+            combined_embeddings, projection, line_mode
+        )
 
-            # Apply DBSCAN on reduced embeddings
-            clustering = self._get_dbscan_clusterer().fit(reduced_embeddings)
-            cluster_labels = clustering.labels_
+        # Clear memory of the per-snippet embeddings; the combined matrix is
+        # reused for the line-by-line similarities
+        del embeddings_a, embeddings_b
+        gc.collect()
+
+        # Apply DBSCAN on reduced embeddings
+        clustering = self._get_dbscan_clusterer(projection).fit(reduced_embeddings)
+        cluster_labels = clustering.labels_
+
+        # Create DataFrame for visualization - more memory efficient
+        df = pd.DataFrame(
+            {
+                "x": reduced_embeddings[:, 0],
+                "y": reduced_embeddings[:, 1],
+                "source": [
+                    "Code Sample 1" if l == 0 else "Code Sample 2" for l in labels
+                ],
+                "cluster": cluster_labels,
+                "text": lines_a + lines_b,
+            }
+        )
 
-            # Create DataFrame for visualization - more memory efficient
-            df = pd.DataFrame(
-                {
-                    "x": reduced_embeddings[:, 0],
-                    "y": reduced_embeddings[:, 1],
-                    "source": [
-                        "Code Sample 1" if l == 0 else "Code Sample 2" for l in labels
+        # Free memory
+        del reduced_embeddings, labels
+        gc.collect()
+
+        # Group points by cluster for visualization
+        cluster_groups = df.groupby("cluster")
+
+        # Calculate centroids for each cluster
+        centroids = {}
+        for cluster_id, group in cluster_groups:
+            if cluster_id != -1:  # Skip noise points
+                centroids[cluster_id] = (group["x"].mean(), group["y"].mean())
+
+        # Create visualization with adjusted points
+        visual_compression = 0.7
+        viz_df = df.copy()
+
+        # Adjust points to centroids
+        for cluster_id in centroids:
+            mask = viz_df["cluster"] == cluster_id
+            if sum(mask) > 0:
+                centroid_x, centroid_y = centroids[cluster_id]
+                viz_df.loc[mask, "x"] = viz_df.loc[
+                    mask, "x"
+                ] * visual_compression + centroid_x * (1 - visual_compression)
+                viz_df.loc[mask, "y"] = viz_df.loc[
+                    mask, "y"
+                ] * visual_compression + centroid_y * (1 - visual_compression)
+
+        # Find similar structures
+        similar_structures = []
+        line_vectors = {}
+        for cluster_id in sorted(set(cluster_labels)):
+            if cluster_id == -1:  # Skip noise points
+                continue
+            cluster_df = df[df["cluster"] == cluster_id]
+            if len(set(cluster_df["source"])) > 1:
+                code_a_lines = cluster_df[cluster_df["source"] == "Code Sample 1"][
+                    "text"
+                ].tolist()
+                code_b_lines = cluster_df[cluster_df["source"] == "Code Sample 2"][
+                    "text"
+                ].tolist()
+                structure_type = self.infer_code_structure_type(
+                    code_a_lines + code_b_lines
+                )
+                similar_structures.append(
+                    {
+                        "cluster_id": int(cluster_id),
+                        "type": structure_type,
+                        "code_a": code_a_lines,
+                        "code_b": code_b_lines,
+                        "similarity": float(
+                            self.calculate_similarity(
+                                "\n".join(code_a_lines), "\n".join(code_b_lines)
+                            )
+                        ),
+                    }
+                )
+                # Rows of df are rows of combined_embeddings
+                line_vectors[int(cluster_id)] = (
+                    combined_embeddings[
+                        cluster_df.index[cluster_df["source"] == "Code Sample 1"]
                     ],
-                    "cluster": cluster_labels,
-                    "text": lines_a + lines_b,
-                }
+                    combined_embeddings[
+                        cluster_df.index[cluster_df["source"] == "Code Sample 2"]
+                    ],
+                )
+
+        # Calculate overall similarity
+        if similar_structures:
+            overall_similarity = sum(
+                structure["similarity"] for structure in similar_structures
+            ) / len(similar_structures)
+        else:
+            overall_similarity = self.calculate_similarity(
+                code_snippet_a, code_snippet_b
             )
 
-            # Free memory
-            del reduced_embeddings, labels
-            gc.collect()
+        # Sort structures
+        similar_structures.sort(key=lambda x: (x["cluster_id"], x["type"]))
+
+        points = [
+            {
+                "x": float(row.x),
+                "y": float(row.y),
+                "source": row.source,
+                "cluster": int(row.cluster),
+                "text": row.text,
+            }
+            for row in viz_df.itertuples(index=False)
+        ]
+        del df, viz_df
+        gc.collect()
+
+        structures = self.enrich_similar_structures(
+            code_snippet_a, code_snippet_b, similar_structures, line_vectors
+        )
+        del combined_embeddings, line_vectors
+
+        return {
+            "key": structure_key(code_snippet_a, code_snippet_b, line_mode, projection),
+            "points": points,
+            "structures": structures,
+            "overall_similarity": float(overall_similarity),
+        }
+
+    def render_structures(
+        self, analysis: dict, dpi: int = 300, fmt: str = "png"
+    ) -> bytes:
+        """Draw an ``analyze_structures`` result as an image in one of RENDER_FORMATS."""
+        if fmt not in RENDER_FORMATS:
+            raise ValueError(f"Unknown image format: {fmt}")
+
+        viz_df = pd.DataFrame(analysis["points"])
+        similar_structures = analysis["structures"]
+        overall_similarity = analysis["overall_similarity"]
+
+        # Draw on a standalone figure rather than pyplot's global state, so
+        # requests rendering in other threads cannot touch or close it
+        fig = Figure(figsize=(14, 12))
+        gs = fig.add_gridspec(1, 2, width_ratios=[2.5, 1])
+        ax = fig.add_subplot(gs[0])
+        legend_ax = fig.add_subplot(gs[1])
+        legend_ax.axis("off")
+        ax.grid(True, linestyle="--", alpha=0.3, zorder=1)
+
+        # Plot points
+        colors = {"Code Sample 1": "#1f77b4", "Code Sample 2": "#ff7f0e"}
+        for source, color in sorted(colors.items()):
+            source_df = viz_df[viz_df["source"] == source]
+            ax.scatter(
+                source_df["x"],
+                source_df["y"],
+                c=color,
+                alpha=0.8,
+                s=100,
+                label=source,
+                zorder=3,
+            )
 
-            # Group points by cluster for visualization
-            cluster_groups = df.groupby("cluster")
-
-            # Calculate centroids for each cluster
-            centroids = {}
-            for cluster_id, group in cluster_groups:
-                if cluster_id != -1:  # Skip noise points
-                    centroids[cluster_id] = (group["x"].mean(), group["y"].mean())
-
-            # Create visualization with adjusted points
-            visual_compression = 0.7
-            viz_df = df.copy()
-
-            # Adjust points to centroids
-            for cluster_id in centroids:
-                mask = viz_df["cluster"] == cluster_id
-                if sum(mask) > 0:
-                    centroid_x, centroid_y = centroids[cluster_id]
-                    viz_df.loc[mask, "x"] = viz_df.loc[
-                        mask, "x"
-                    ] * visual_compression + centroid_x * (1 - visual_compression)
-                    viz_df.loc[mask, "y"] = viz_df.loc[
-                        mask, "y"
-                    ] * visual_compression + centroid_y * (1 - visual_compression)
-
-            # Find similar structures
-            similar_structures = []
-            for cluster_id in sorted(set(cluster_labels)):
-                if cluster_id == -1:  # Skip noise points
-                    continue
-                cluster_df = df[df["cluster"] == cluster_id]
-                if len(set(cluster_df["source"])) > 1:
-                    code_a_lines = cluster_df[cluster_df["source"] == "Code Sample 1"][
-                        "text"
-                    ].tolist()
-                    code_b_lines = cluster_df[cluster_df["source"] == "Code Sample 2"][
-                        "text"
-                    ].tolist()
-                    structure_type = self.infer_code_structure_type(
-                        code_a_lines + code_b_lines
-                    )
-                    similar_structures.append(
-                        {
-                            "cluster_id": int(cluster_id),
-                            "type": structure_type,
-                            "code_a": code_a_lines,
-                            "code_b": code_b_lines,
-                            "similarity": float(
-                                self.calculate_similarity(
-                                    "\n".join(code_a_lines), "\n".join(code_b_lines)
-                                )
-                            ),
-                        }
+        # Draw convex hulls
+        for structure in similar_structures:
+            cluster_points = viz_df[viz_df["cluster"] == structure["cluster_id"]]
+            if len(cluster_points) >= 3:
+                points = cluster_points[["x", "y"]].values
+                try:
+                    hull = ConvexHull(points)
+                    hull_points = points[hull.vertices]
+
+                    # Calculate centroid and pad hull
+                    centroid = np.mean(hull_points, axis=0)
+                    padded_hull_points = []
+                    for point in hull_points:
+                        vector = point - centroid
+                        padded_point = centroid + vector * 1.05
+                        padded_hull_points.append(padded_point)
+
+                    padded_hull_points = np.array(padded_hull_points)
+                    ax.fill(
+                        padded_hull_points[:, 0],
+                        padded_hull_points[:, 1],
+                        alpha=0.3,
+                        color="gray",
+                        zorder=2,
                     )
+                except Exception:
+                    # Skip drawing convex hull if any errors occur
+                    pass
+
+            # Add cluster number
+            centroid = (cluster_points["x"].mean(), cluster_points["y"].mean())
+            ax.text(
+                centroid[0],
+                centroid[1],
+                f"{structure['cluster_id']}",
+                ha="center",
+                va="center",
+                fontsize=10,
+                fontweight="bold",
+                bbox=dict(facecolor="white", alpha=0.7, edgecolor="none", pad=1),
+                zorder=4,
+            )
 
-            # Calculate overall similarity
-            if similar_structures:
-                overall_similarity = sum(
-                    structure["similarity"] for structure in similar_structures
-                ) / len(similar_structures)
-            else:
-                overall_similarity = self.calculate_similarity(
-                    code_snippet_a, code_snippet_b
-                )
+        # Add descriptive axes labels
+        ax.set_xlabel("Semantic Distance (Dimension 1)", fontsize=10)
+        ax.set_ylabel("Semantic Distance (Dimension 2)", fontsize=10)
+
+        # Add title and subtitle with colored similarity score
+        similarity_color = (
+            "#ef4444"  # Red for high similarity (70-100%)
+            if overall_similarity >= 0.7
+            else (
+                "#eab308"  # Orange for medium similarity (40-70%)
+                if overall_similarity >= 0.4
+                else "#22c55e"
+            )  # Green for low similarity (<40%)
+        )
+        fig.suptitle("Code Structure Comparison", fontsize=16, y=0.92)
+        ax.set_title(
+            f"Overall Similarity: {overall_similarity:.2%}",
+            fontsize=14,
+            color=similarity_color,
+            weight="bold",
+            pad=40,
+        )
 
-            # Sort structures
-            similar_structures.sort(key=lambda x: (x["cluster_id"], x["type"]))
-
-            # Create visualization with plt
-            plt.figure(figsize=(14, 12))
-            gs = gridspec.GridSpec(1, 2, width_ratios=[2.5, 1])
-            ax = plt.subplot(gs[0])
-            legend_ax = plt.subplot(gs[1])
-            legend_ax.axis("off")
-            ax.grid(True, linestyle="--", alpha=0.3, zorder=1)
-
-            # Plot points
-            colors = {"Code Sample 1": "#1f77b4", "Code Sample 2": "#ff7f0e"}
-            for source, color in sorted(colors.items()):
-                source_df = viz_df[viz_df["source"] == source]
-                ax.scatter(
-                    source_df["x"],
-                    source_df["y"],
-                    c=color,
-                    alpha=0.8,
-                    s=100,
-                    label=source,
-                    zorder=3,
-                )
+        # Create proper legend
+        ax.legend(title="Code Samples", loc="upper left", frameon=True, framealpha=0.9)
 
-            # Draw convex hulls
+        # Create a clean, readable legend for similar structures in the right subplot
+        if similar_structures:
+            # Sort by cluster_id for consistent ordering (without touching the
+            # analysis, which may be cached and shared)
+            similar_structures = sorted(
+                similar_structures, key=lambda x: x["cluster_id"]
+            )
+
+            legend_content = "Similar Code Structures:\n\n"
             for structure in similar_structures:
-                cluster_points = viz_df[viz_df["cluster"] == structure["cluster_id"]]
-                if len(cluster_points) >= 3:
-                    points = cluster_points[["x", "y"]].values
-                    try:
-                        hull = ConvexHull(points)
-                        hull_points = points[hull.vertices]
-
-                        # Calculate centroid and pad hull
-                        centroid = np.mean(hull_points, axis=0)
-                        padded_hull_points = []
-                        for point in hull_points:
-                            vector = point - centroid
-                            padded_point = centroid + vector * 1.05
-                            padded_hull_points.append(padded_point)
-
-                        padded_hull_points = np.array(padded_hull_points)
-                        ax.fill(
-                            padded_hull_points[:, 0],
-                            padded_hull_points[:, 1],
-                            alpha=0.3,
-                            color="gray",
-                            zorder=2,
-                        )
-                    except Exception:
-                        # Skip drawing convex hull if any errors occur
-                        pass
-
-                # Add cluster number
-                centroid = (cluster_points["x"].mean(), cluster_points["y"].mean())
-                ax.text(
-                    centroid[0],
-                    centroid[1],
-                    f"{structure['cluster_id']}",
-                    ha="center",
-                    va="center",
-                    fontsize=10,
-                    fontweight="bold",
-                    bbox=dict(facecolor="white", alpha=0.7, edgecolor="none", pad=1),
-                    zorder=4,
+                legend_content += (
+                    f"Cluster {structure['cluster_id']}:\n"
+                    f"• Type: {structure['type']}\n"
+                    f"• Similarity: {structure['similarity']:.2%}\n\n"
                 )
 
-            # Add descriptive axes labels
-            ax.set_xlabel("Semantic Distance (Dimension 1)", fontsize=10)
-            ax.set_ylabel("Semantic Distance (Dimension 2)", fontsize=10)
-
-            # Add title and subtitle with colored similarity score
-            similarity_color = (
-                "#ef4444"  # Red for high similarity (70-100%)
-                if overall_similarity >= 0.7
-                else (
-                    "#eab308"  # Orange for medium similarity (40-70%)
-                    if overall_similarity >= 0.4
-                    else "#22c55e"
-                )  # Green for low similarity (<40%)
+            legend_ax.text(
+                0,
+                0.95,
+                legend_content,
+                va="top",
+                ha="left",
+                fontsize=10,
+                linespacing=1.5,
+                bbox=dict(
+                    facecolor="white",
+                    edgecolor="lightgray",
+                    boxstyle="round,pad=0.5",
+                ),
             )
-            plt.suptitle("Code Structure Comparison", fontsize=16, y=0.92)
-            ax.set_title(
-                f"Overall Similarity: {overall_similarity:.2%}",
-                fontsize=14,
-                color=similarity_color,
-                weight="bold",
-                pad=40,
+        else:
+            legend_ax.text(
+                0,
+                0.5,
+                "No similar structures detected",
+                va="center",
+                ha="left",
+                fontsize=12,
             )
 
-            # Create proper legend
-            ax.legend(
-                title="Code Samples", loc="upper left", frameon=True, framealpha=0.9
-            )
+        # Update axis limits to focus on visualization data
+        x_min, x_max = viz_df["x"].min(), viz_df["x"].max()
+        y_min, y_max = viz_df["y"].min(), viz_df["y"].max()
+        x_margin = (x_max - x_min) * 0.05
+        y_margin = (y_max - y_min) * 0.05
+        ax.set_xlim(x_min - x_margin, x_max + x_margin)
+        ax.set_ylim(y_min - y_margin, y_max + y_margin)
+        ax.set_aspect("equal")
+
+        # Adjust layout
+        fig.tight_layout()
+
+        # Save the image in the requested resolution and format
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fmt, dpi=dpi, bbox_inches="tight", pad_inches=0.4)
+        return buf.getvalue()
+
+    def render_error_image(self, message: str) -> str:
+        """Small PNG data URI showing an error message in place of the plot."""
+        fig = Figure(figsize=(6, 4))
+        fig.text(0.5, 0.5, f"Error: {message}", ha="center", va="center")
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png")
+        buf.seek(0)
+        error_img = base64.b64encode(buf.read()).decode("utf-8")
+        buf.close()
+        return f"data:image/png;base64,{error_img}"
 
-            # Create a clean, readable legend for similar structures in the right subplot
-            if similar_structures:
-                # Sort by cluster_id for consistent ordering
-                similar_structures.sort(key=lambda x: x["cluster_id"])
-
-                legend_content = "Similar Code Structures:\n\n"
-                for structure in similar_structures:
-                    legend_content += (
-                        f"Cluster {structure['cluster_id']}:\n"
-                        f"• Type: {structure['type']}\n"
-                        f"• Similarity: {structure['similarity']:.2%}\n\n"
-                    )
-
-                legend_ax.text(
-                    0,
-                    0.95,
-                    legend_content,
-                    va="top",
-                    ha="left",
-                    fontsize=10,
-                    linespacing=1.5,
-                    bbox=dict(
-                        facecolor="white",
-                        edgecolor="lightgray",
-                        boxstyle="round,pad=0.5",
-                    ),
-                )
-            else:
-                legend_ax.text(
-                    0,
-                    0.5,
-                    "No similar structures detected",
-                    va="center",
-                    ha="left",
-                    fontsize=12,
-                )
+    def visualize_code_similarity(
+        self,
+        code_snippet_a: str,
+        code_snippet_b: str,
+        dim: int = 2,
+        line_mode: str = "independent",
+        projection: Optional[str] = None,
+    ) -> tuple[str, list[dict]]:
+        """Generate visualization for code similarity between two snippets with improved readability."""
+        projection = check_structure_options(line_mode, projection)
 
-            # Update axis limits to focus on visualization data
-            x_min, x_max = viz_df["x"].min(), viz_df["x"].max()
-            y_min, y_max = viz_df["y"].min(), viz_df["y"].max()
-            x_margin = (x_max - x_min) * 0.05
-            y_margin = (y_max - y_min) * 0.05
-            ax.set_xlim(x_min - x_margin, x_max + x_margin)
-            ax.set_ylim(y_min - y_margin, y_max + y_margin)
-            ax.set_aspect("equal")
-
-            # Adjust layout
-            plt.tight_layout()
-
-            # Save high-quality image with fixed DPI and format
-            buf = io.BytesIO()
-            plt.savefig(buf, format="png", dpi=300, bbox_inches="tight", pad_inches=0.4)
-            plt.close("all")  # Close plots to free memory
-            buf.seek(0)
-            img_base64 = base64.b64encode(buf.read()).decode("utf-8")
-            buf.close()  # Explicitly close buffer
-
-            # Enrich structures
-            enriched_structures = self.enrich_similar_structures(
-                code_snippet_a, code_snippet_b, similar_structures
+        try:
+            analysis = self.analyze_structures(
+                code_snippet_a, code_snippet_b, line_mode, projection
             )
+            image = self.render_structures(analysis)
+            img_base64 = base64.b64encode(image).decode("utf-8")
 
             # Force garbage collection before returning
             gc.collect()
 
-            return f"data:image/png;base64,{img_base64}", enriched_structures
+            return f"data:image/png;base64,{img_base64}", analysis["structures"]
 
         except Exception as e:
             print(f"Visualization error: {str(e)}")
-            fig = plt.figure(figsize=(6, 4))
-            plt.text(0.5, 0.5, f"Error: {str(e)}", ha="center", va="center")
-            plt.axis("off")
-            buf = io.BytesIO()
-            plt.savefig(buf, format="png")
-            plt.close("all")
-            buf.seek(0)
-            error_img = base64.b64encode(buf.read()).decode("utf-8")
-            buf.close()
-            return f"data:image/png;base64,{error_img}", []
+            return self.render_error_image(str(e)), []
@@ -1,25 +1,23 @@
-from transformers import RobertaModel, RobertaTokenizer
 import torch
 from .codebert_analyzer import CodeBERTAnalyzer
+from .model_registry import default_device, get_model, get_tokenizer
 
 class CodeSimilarityAnalyzer:
     def __init__(self, model_name="microsoft/codebert-base"):
         self.model_name = model_name
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = default_device()
         self.model = None
         self.tokenizer = None
         self._load_model()
 
     def _load_model(self):
         if self.model is None:
-            self.model = RobertaModel.from_pretrained(
-                self.model_name, 
-                output_attentions=True
-            ).to(self.device)
+            # Shared copy; attentions are requested per call in analyze_attention
+            self.model = get_model(self.model_name, self.device)
             print(f"CodeBERT Model loaded on {self.device}")
             
         if self.tokenizer is None:
-            self.tokenizer = RobertaTokenizer.from_pretrained(self.model_name)
+            self.tokenizer = get_tokenizer(self.model_name)
 
     def analyze_attention(self, code1, code2, layer=4, head=3):
         try:
@@ -1,10 +1,36 @@
-import torch
-from transformers import RobertaTokenizer, RobertaModel
 import numpy as np
-from typing import List, Dict, Tuple, Optional
+from typing import Callable, List, Dict, Tuple, Optional, Iterator
 import re
+import os
+import hashlib
+import threading
 from dataclasses import dataclass
 
+try:
+    from .embedding_cache import EmbeddingCache
+    from .embedding_store import EmbeddingStore
+    from .embedding_dispatcher import EmbeddingDispatcher
+    from .model_registry import (
+        QUANTIZATION_MODES,
+        default_device,
+        get_model,
+        get_onnx_session,
+        get_tokenizer,
+    )
+except ImportError:
+    # Flat copy next to server/Docker/flask/app.py, which imports this file as
+    # a top-level module; the modules above are copied alongside it
+    from embedding_cache import EmbeddingCache
+    from embedding_store import EmbeddingStore
+    from embedding_dispatcher import EmbeddingDispatcher
+    from model_registry import (
+        QUANTIZATION_MODES,
+        default_device,
+        get_model,
+        get_onnx_session,
+        get_tokenizer,
+    )
+
 # unused import statements
 # import matplotlib
 
@@ -29,6 +55,7 @@ class SnippetInfo:
     file_name: str
     code: str
     timestamp: str
+    submission_id: str = ""
 
 
 # @dataclass
@@ -58,27 +85,168 @@ class SequentialSimilarity:
     codebert_score: float
 
 
+@dataclass
+class TokenizationStats:
+    """Truncation and padding counters for one or more encoding passes."""
+    texts: int = 0
+    char_truncated: int = 0
+    chars_dropped: int = 0
+    token_truncated: int = 0
+    tokens_dropped: int = 0
+    windows: int = 0
+    batches: int = 0
+    real_tokens: int = 0
+    padded_tokens: int = 0
+
+    @property
+    def padding_ratio(self) -> float:
+        """Share of the encoded positions that were padding."""
+        if not self.padded_tokens:
+            return 0.0
+        return 1 - self.real_tokens / self.padded_tokens
+
+    def merge(self, other: "TokenizationStats"):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self) -> Dict:
+        stats = {name: getattr(self, name) for name in self.__dataclass_fields__}
+        stats["padding_ratio"] = round(self.padding_ratio, 4)
+        return stats
+
+
+# Bump whenever preprocess_code changes what the model sees; stored
+# embeddings from older versions then stop matching and get pruned
+PREPROCESS_VERSION = 1
+
+EMBEDDING_MODES = ("truncate", "sliding_window")
+
+EMBEDDING_BACKENDS = ("torch", "onnx")
+
+
+def pack_upper_triangle(scores: np.ndarray) -> bytes:
+    """Pack the cells above the diagonal of a uint8 score matrix into bytes."""
+    rows, cols = np.triu_indices(len(scores), 1)
+    return scores[rows, cols].astype(np.uint8, copy=False).tobytes()
+
+
+def unpack_upper_triangle(data: bytes, size: int) -> np.ndarray:
+    """Rebuild the symmetric score matrix packed by pack_upper_triangle."""
+    rows, cols = np.triu_indices(size, 1)
+    scores = np.full((size, size), 100, dtype=np.uint8)
+    scores[rows, cols] = scores[cols, rows] = np.frombuffer(data, dtype=np.uint8)
+    return scores
+
+
 class CodeBERTAnalyzer:
-    def __init__(self, model_path: Optional[str] = None):
+    def __init__(
+        self,
+        model_path: Optional[str] = None,
+        max_batch_size: int = 16,
+        max_batch_tokens: int = 8192,
+        store_path: Optional[str] = None,
+        cache_budgets: Optional[Dict[str, int]] = None,
+        cache_dtype: Optional[str] = None,
+        embedding_mode: Optional[str] = None,
+        window_stride: int = 384,
+        max_windows: int = 8,
+        quantization: Optional[str] = None,
+        backend: Optional[str] = None,
+        onnx_path: Optional[str] = None,
+        intra_op_threads: Optional[int] = None,
+        micro_batch_ms: Optional[float] = None,
+    ):
         """Initialize the CodeBERT analyzer with local model."""
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.embedding_cache = {}
+        self.model_name = model_path or "microsoft/codebert-base"
+
+        # "onnx" runs an encoder exported by analyzer/onnx_export.py through
+        # onnxruntime; it yields the same vectors, so cache keys are shared
+        self.backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+        if self.backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {self.backend}")
+        self.onnx_path = onnx_path or os.getenv("ONNX_MODEL_PATH")
+        if self.backend == "onnx" and not self.onnx_path:
+            raise ValueError("The onnx backend needs onnx_path or ONNX_MODEL_PATH")
+        if intra_op_threads is None:
+            intra_op_threads = int(os.getenv("ONNX_INTRA_OP_THREADS", 0))
+        self.intra_op_threads = intra_op_threads
+        self.session = None
+
+        self.device = default_device() if self.backend == "torch" else None
+        # "int8" runs the encoder with dynamically quantized Linear layers (CPU
+        # only); an explicit "none" keeps fp32 even when EMBEDDING_QUANTIZATION is set
+        quantization = quantization or os.getenv("EMBEDDING_QUANTIZATION") or "none"
+        self.quantization = None if quantization == "none" else quantization
+        if self.quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {self.quantization}")
+        if self.quantization is not None and self.backend != "torch":
+            raise ValueError("Quantization is only available with the torch backend")
+        # float16 halves resident memory at the cost of slightly rounded scores
+        self.embedding_cache = EmbeddingCache(
+            cache_budgets, cache_dtype or os.getenv("EMBEDDING_CACHE_DTYPE", "float32")
+        )
         self.scaling_exponent = 3.0
         self.amplification_factor = 5.0
         self.tokenizer = None
         self.model = None
 
+        # Upper bounds for a single padded forward pass
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_tokens = 512
+
+        # "truncate" embeds the first ~509 characters; "sliding_window" embeds
+        # the whole snippet as overlapping windows pooled into one vector
+        self.embedding_mode = embedding_mode or os.getenv("EMBEDDING_MODE", "truncate")
+        if self.embedding_mode not in EMBEDDING_MODES:
+            raise ValueError(f"Unknown embedding mode: {self.embedding_mode}")
+        self.window_stride = window_stride
+        self.max_windows = max_windows
+
+        # Truncation/padding counters for the latest encode and since startup
+        self.last_tokenization_stats = TokenizationStats()
+        self.tokenization_stats = TokenizationStats()
+        self._stats_lock = threading.Lock()
+
+        # With a positive wait, cache misses from concurrent requests are
+        # pooled for up to that many milliseconds into one forward pass
+        if micro_batch_ms is None:
+            micro_batch_ms = float(os.getenv("EMBEDDING_MICRO_BATCH_MS", 0))
+        self.dispatcher = (
+            EmbeddingDispatcher(
+                self._encode_texts, micro_batch_ms, 4 * self.max_batch_size
+            )
+            if micro_batch_ms > 0
+            else None
+        )
+
+        # Optional persistent store shared across restarts and workers
+        store_path = store_path or os.getenv("EMBEDDING_STORE_PATH")
+        self.embedding_store = EmbeddingStore(store_path) if store_path else None
+        if self.embedding_store is not None:
+            self.embedding_store.prune(PREPROCESS_VERSION)
+            # The analyzer may be built in a gunicorn master; let each
+            # worker open its own connection after the fork
+            self.embedding_store.close()
+
     def _ensure_model_loaded(self):
         """Lazy load models only when needed"""
         if self.tokenizer is None:
-            self.tokenizer = RobertaTokenizer.from_pretrained("microsoft/codebert-base")
-        if self.model is None:
-            self.model = RobertaModel.from_pretrained("microsoft/codebert-base")
-            self.model.to(self.device)
-            self.model.eval()
+            self.tokenizer = get_tokenizer(self.model_name)
+        if self.backend == "onnx":
+            if self.session is None:
+                self.session = get_onnx_session(self.onnx_path, self.intra_op_threads)
+        elif self.model is None:
+            self.model = get_model(
+                self.model_name, self.device, quantization=self.quantization
+            )
 
     def preprocess_code(self, code: str) -> str:
         """Preprocess code for CodeBERT analysis."""
+        return self._truncate_code(self.normalize_code(code))
+
+    def normalize_code(self, code: str) -> str:
+        """Strip whitespace, imports and includes without truncating."""
         # Normalize whitespace and remove newlines/tabs
         code = re.sub(r"\s+", "", code).replace("\n", "").replace("\t", "").strip()
         
@@ -89,109 +257,571 @@ class CodeBERTAnalyzer:
         code = re.sub(r"#include\s+[<\"].*?[>\"]", "", code)
         
         # Remove excessive whitespace again after normalization
-        code = ' '.join(code.split())
-        
+        return ' '.join(code.split())
+
+    def _truncate_code(self, code: str) -> str:
         # Truncate to 512 tokens with proper word boundary
         return code[:509].rsplit(" ", 1)[0] + "..." if len(code) > 512 else code
     
-    def get_embedding(self, code: str) -> np.ndarray:
+    def _model_text(self, code: str) -> str:
+        """The text actually encoded for code under the current embedding mode."""
+        normalized = self.normalize_code(code)
+        if self.embedding_mode == "sliding_window":
+            return normalized
+        return self._truncate_code(normalized)
+
+    def get_embedding(self, code: str, namespace: str = "snippet") -> np.ndarray:
         """Get code embedding using CodeBERT with mean pooling."""
+        return self.get_embeddings([code], namespace)[0]
+
+    def embedding_key(self, preprocessed: str) -> str:
+        """Stable content digest for a preprocessed snippet under the current model."""
+        parts = [self.model_name, str(PREPROCESS_VERSION)]
+        if self.embedding_mode == "sliding_window":
+            parts.append(
+                f"{self.embedding_mode}:{self.window_stride}:{self.max_windows}"
+            )
+        if self.quantization is not None:
+            parts.append(f"quantization:{self.quantization}")
+        payload = "\0".join(parts + [preprocessed])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_embeddings(
+        self, codes: List[str], namespace: str = "snippet"
+    ) -> List[np.ndarray]:
+        """Get embeddings for many snippets, running the model in padded mini-batches.
+
+        ``namespace`` selects the cache pool: "snippet" for whole submissions,
+        "line" for the per-line embeddings used by structural analysis.
+        """
+        return self._get_embeddings(codes, namespace)[1]
+
+    def get_embedding_matrix(
+        self, codes: List[str], namespace: str = "snippet"
+    ) -> np.ndarray:
+        """Get embeddings for codes as one (n, dim) float64 matrix.
+
+        The GEMM in _score_rows needs float64 to keep scores exact, so the rows
+        are converted out of the cache arena in one copy when every snippet is
+        resident, and only stacked one by one when the room is too large for
+        the cache budget.
+        """
+        keys, embeddings = self._get_embeddings(codes, namespace)
+        matrix = self.embedding_cache.gather(namespace, keys)
+        if matrix is None:
+            matrix = np.stack(embeddings).astype(np.float64)
+        return matrix
+
+    def _get_embeddings(
+        self, codes: List[str], namespace: str
+    ) -> Tuple[List[str], List[np.ndarray]]:
+        keys = []
+        embeddings: List[Optional[np.ndarray]] = [None] * len(codes)
+
+        # Group cache misses by key so duplicate snippets are only encoded once
+        pending: Dict[str, List[int]] = {}
+        texts: Dict[str, str] = {}
+        chars_dropped: Dict[str, int] = {}
+        for i, code in enumerate(codes):
+            normalized = self.normalize_code(code)
+            if self.embedding_mode == "sliding_window":
+                preprocessed = normalized
+            else:
+                preprocessed = self._truncate_code(normalized)
+            cache_key = self.embedding_key(preprocessed)
+            keys.append(cache_key)
+            cached = self.embedding_cache.get(namespace, cache_key)
+            if cached is not None:
+                embeddings[i] = cached
+            else:
+                pending.setdefault(cache_key, []).append(i)
+                texts[cache_key] = preprocessed
+                if preprocessed != normalized:
+                    # Less the "..." marker appended on truncation
+                    chars_dropped[cache_key] = len(normalized) - len(preprocessed) + 3
+
+        if pending and self.embedding_store is not None:
+            for cache_key, embedding in self.embedding_store.get_many(pending).items():
+                embedding = self.embedding_cache.put(namespace, cache_key, embedding)
+                for i in pending.pop(cache_key):
+                    embeddings[i] = embedding
+
+        if pending:
+            missing = list(pending)
+            stats = TokenizationStats(
+                char_truncated=sum(key in chars_dropped for key in missing),
+                chars_dropped=sum(chars_dropped.get(key, 0) for key in missing),
+            )
+            missing_texts = [texts[key] for key in missing]
+            if self.dispatcher is not None:
+                # Token counters are recorded per shared batch by the dispatcher
+                self._record_stats(stats)
+                computed = dict(zip(missing, self.dispatcher.embed(missing_texts)))
+            else:
+                computed = dict(zip(missing, self._encode_texts(missing_texts, stats)))
+            for cache_key, embedding in computed.items():
+                embedding = self.embedding_cache.put(namespace, cache_key, embedding)
+                for i in pending[cache_key]:
+                    embeddings[i] = embedding
+
+            if self.embedding_store is not None:
+                self.embedding_store.put_many(computed, PREPROCESS_VERSION)
+
+        return keys, embeddings
+
+    def _encode_texts(
+        self, texts: List[str], stats: Optional[TokenizationStats] = None
+    ) -> List[np.ndarray]:
+        stats = stats if stats is not None else TokenizationStats()
+        embeddings = self._embed_texts(texts, stats)
+        self._record_stats(stats)
+        return embeddings
+
+    def _record_stats(self, stats: TokenizationStats):
+        with self._stats_lock:
+            self.last_tokenization_stats = stats
+            self.tokenization_stats.merge(stats)
+
+    def _plan_batches(self, lengths: List[int]) -> List[List[int]]:
+        """Group indices of similar token length into batches within the size/token budget."""
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches = []
+        batch = []
+        for i in order:
+            # Sorted ascending, so the newest item sets the padded length
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or (len(batch) + 1) * lengths[i] > self.max_batch_tokens
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _tokenize(
+        self, texts: List[str], stats: TokenizationStats
+    ) -> Tuple[List[List[int]], List[int]]:
+        """Tokenize texts into model-sized windows, counting what gets cut off.
+
+        Returns the token ids of every window and the index of the text each
+        window belongs to. In "truncate" mode every text is one window cut to
+        the model limit; in "sliding_window" mode long texts are split into
+        overlapping windows of up to ``max_tokens`` tokens, at most
+        ``max_windows`` per text.
+        """
+        input_ids = self.tokenizer(texts, verbose=False)["input_ids"]
+        stats.texts += len(texts)
+
+        windows, owners = [], []
+        span = self.max_tokens - 2  # room left by <s> and </s>
+        for i, ids in enumerate(input_ids):
+            if len(ids) <= self.max_tokens:
+                windows.append(ids)
+                owners.append(i)
+                continue
+
+            bos, content, eos = ids[:1], ids[1:-1], ids[-1:]
+            if self.embedding_mode == "sliding_window":
+                starts = list(range(0, len(content) - span, self.window_stride))
+                starts.append(len(content) - span)
+                starts = starts[: self.max_windows]
+            else:
+                starts = [0]
+
+            # Keep the closing </s> like the tokenizer's own truncation
+            for start in starts:
+                windows.append(bos + content[start : start + span] + eos)
+                owners.append(i)
+            covered = starts[-1] + span
+            if covered < len(content):
+                stats.token_truncated += 1
+                stats.tokens_dropped += len(content) - covered
+
+        stats.windows += len(windows)
+        return windows, owners
+
+    def _embed_texts(
+        self, texts: List[str], stats: Optional[TokenizationStats] = None
+    ) -> List[np.ndarray]:
+        """Encode preprocessed texts and return normalized mean-pooled embeddings."""
         self._ensure_model_loaded()  # Lazy load the model
 
-        cache_key = hash(code)
-        if cache_key in self.embedding_cache:
-            return self.embedding_cache[cache_key]
-
-        preprocessed = self.preprocess_code(code)
+        stats = stats if stats is not None else TokenizationStats()
+        windows, owners = self._tokenize(texts, stats)
+        window_means: List[Optional[np.ndarray]] = [None] * len(windows)
+
+        # Windows of every text share the batches, sorted by length
+        for batch in self._plan_batches([len(ids) for ids in windows]):
+            lengths = [len(windows[i]) for i in batch]
+            stats.batches += 1
+            stats.real_tokens += sum(lengths)
+            stats.padded_tokens += len(batch) * max(lengths)
+            pooled = self._encode_batch([windows[i] for i in batch])
+
+            for row, i in enumerate(batch):
+                window_means[i] = pooled[row]
+
+        # Combine the windows of each text with a mean weighted by token count
+        grouped: List[List[int]] = [[] for _ in texts]
+        for i, owner in enumerate(owners):
+            grouped[owner].append(i)
+        pooled = np.stack(
+            [
+                window_means[group[0]]
+                if len(group) == 1
+                else np.average(
+                    [window_means[i] for i in group],
+                    axis=0,
+                    weights=[len(windows[i]) for i in group],
+                ).astype(np.float32)
+                for group in grouped
+            ]
+        )
+
+        # Normalize the embeddings
+        pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+
+        # Copy so cached rows do not pin the whole pooled array
+        return [row.copy() for row in pooled]
+
+    def _encode_batch(self, input_ids: List[List[int]]) -> np.ndarray:
+        """Run one padded forward pass and return the masked mean of each row."""
+        if self.backend == "onnx":
+            inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="np")
+            # The exported graph does the same masked mean pooling
+            return self.session.run(
+                ["embeddings"],
+                {
+                    "input_ids": inputs["input_ids"].astype(np.int64),
+                    "attention_mask": inputs["attention_mask"].astype(np.int64),
+                },
+            )[0]
+
+        import torch
+
+        inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
 
         with torch.no_grad():
-            inputs = self.tokenizer(
-                preprocessed,
-                return_tensors="pt",
-                max_length=512,
-                truncation=True,
-                padding=True,
-            )
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
             outputs = self.model(**inputs)
 
-            # Use mean pooling
-            embedding = outputs.last_hidden_state.mean(dim=1).cpu().numpy()[0]
-
-            # Normalize the embedding
-            embedding /= np.linalg.norm(embedding)
-
-            self.embedding_cache[cache_key] = embedding
-            if len(self.embedding_cache) > 1000:
-                self.embedding_cache.pop(next(iter(self.embedding_cache)))
-            return embedding
-
-    def calculate_similarity(self, code1: str, code2: str) -> float:
+            # Mean pooling over real tokens only
+            mask = inputs["attention_mask"].unsqueeze(-1).to(
+                outputs.last_hidden_state.dtype
+            )
+            summed = (outputs.last_hidden_state * mask).sum(dim=1)
+            return (summed / mask.sum(dim=1).clamp(min=1)).cpu().numpy()
+
+    def get_contextual_line_embeddings(
+        self, code: str
+    ) -> Tuple[np.ndarray, List[str]]:
+        """Embed every non-empty line of a snippet from one pass over the whole snippet.
+
+        The raw snippet is tokenized once and the tokenizer's offset mapping
+        ties each token back to its source line; a line's vector is the mean
+        of its contextual token states, so it carries the surrounding code.
+        Lines that get no tokens fall back to the independent line embedding.
+        """
+        lines, line_starts = [], []
+        start = 0
+        for line in code.split("\n"):
+            if line.strip():
+                lines.append(line)
+                line_starts.append(start)
+            start += len(line) + 1  # +1 for newline character
+        if not lines:
+            return np.array([]), lines
+
+        tokenizer = get_tokenizer(self.model_name, fast=True)
+        encoding = tokenizer(
+            code,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+        states = self._token_states(encoding["input_ids"])
+
+        # Whitespace and newline tokens belong to no line
+        kept = [
+            (i, begin)
+            for i, (begin, end) in enumerate(encoding["offset_mapping"])
+            if code[begin:end].strip()
+        ]
+        token_rows = np.array([i for i, _ in kept], dtype=np.int64)
+        token_lines = (
+            np.searchsorted(line_starts, [begin for _, begin in kept], side="right")
+            - 1
+        )
+
+        sums = np.zeros((len(lines), states.shape[1]), dtype=np.float64)
+        np.add.at(sums, token_lines, states[token_rows])
+        counts = np.bincount(token_lines, minlength=len(lines))
+
+        embeddings = np.zeros(sums.shape, dtype=np.float32)
+        pooled = counts > 0
+        embeddings[pooled] = sums[pooled] / counts[pooled, None]
+        embeddings[pooled] /= np.linalg.norm(embeddings[pooled], axis=1, keepdims=True)
+
+        missing = np.flatnonzero(~pooled)
+        if len(missing):
+            fallback = self.get_embeddings(
+                [self.preprocess_code(lines[i]) for i in missing], "line"
+            )
+            embeddings[missing] = np.stack(fallback)
+        return embeddings, lines
+
+    def _token_states(self, input_ids: List[int]) -> np.ndarray:
+        """Last hidden state of every token of one sequence of any length.
+
+        Sequences over the model limit are run as overlapping windows and a
+        token seen by several windows gets the mean of its states. The ONNX
+        graph only returns pooled vectors, so this always uses the torch model.
+        """
+        import torch
+
+        if self.backend == "onnx":
+            device = default_device()
+            model = get_model(self.model_name, device)
+        else:
+            self._ensure_model_loaded()
+            device, model = self.device, self.model
+        tokenizer = get_tokenizer(self.model_name)
+
+        span = self.max_tokens - 2  # room left by <s> and </s>
+        starts = list(range(0, max(len(input_ids) - span, 0), self.window_stride))
+        starts.append(max(len(input_ids) - span, 0))
+
+        sums = np.zeros((len(input_ids), model.config.hidden_size), dtype=np.float64)
+        counts = np.zeros(len(input_ids), dtype=np.int64)
+        for b in range(0, len(starts), self.max_batch_size):
+            batch = starts[b : b + self.max_batch_size]
+            windows = [
+                [tokenizer.bos_token_id]
+                + input_ids[start : start + span]
+                + [tokenizer.eos_token_id]
+                for start in batch
+            ]
+            inputs = tokenizer.pad({"input_ids": windows}, return_tensors="pt")
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+            with torch.no_grad():
+                hidden = model(**inputs).last_hidden_state.float().cpu().numpy()
+
+            for row, start in enumerate(batch):
+                length = len(windows[row]) - 2
+                sums[start : start + length] += hidden[row, 1 : length + 1]
+                counts[start : start + length] += 1
+
+        return sums / np.maximum(counts, 1)[:, None]
+
+    def calculate_similarity(
+        self, code1: str, code2: str, namespace: str = "snippet"
+    ) -> float:
         """Calculate similarity between two code snippets with improved scaling."""
-        emb1 = self.get_embedding(code1)
-        emb2 = self.get_embedding(code2)
+        emb1, emb2 = self.get_embeddings([code1, code2], namespace)
 
-        # Base similarity (cosine similarity)
-        cosine_sim = np.dot(emb1, emb2)
+        # Base similarity (cosine similarity), accumulated in float64 so the
+        # result does not depend on BLAS summation order (see compute_similarity_scores)
+        cosine_sim = np.float32(np.dot(emb1.astype(np.float64), emb2.astype(np.float64)))
 
-        # Apply non-linear transformation to emphasize differences
-        similarity = cosine_sim
+        return self._transform_similarity(cosine_sim)
 
+    def _transform_similarity(self, cosine_sim):
+        """Apply the non-linear score transform to a cosine similarity (scalar or array)."""
         # Step 1: Convert to a distance measure (0 = identical, higher = more different)
-        distance = 1 - similarity
-
-        # Ensure distance is non-negative
-        if distance < 0:
-            distance = 0
+        # and ensure it is non-negative
+        distance = np.maximum(1 - cosine_sim, 0)
 
         # Step 2: Amplify the distance (makes small differences larger)
         amplified_distance = distance * self.amplification_factor
 
-        # Ensure amplified_distance is non-negative
-        if amplified_distance < 0:
-            amplified_distance = 0
-
         # Step 3: Apply non-linear scaling (exponential) to further separate close values
-        scaled_distance = min(1, amplified_distance ** (1 / self.scaling_exponent))
+        scaled_distance = np.minimum(1, amplified_distance ** (1 / self.scaling_exponent))
 
         # Step 4: Convert back to similarity score
         transformed_similarity = 1 - scaled_distance
 
-        return max(0, transformed_similarity)
+        return np.maximum(transformed_similarity, 0)
+
+    def _score_rows(self, embeddings: np.ndarray, rows) -> np.ndarray:
+        """Score the selected rows of an embedding matrix against every row."""
+        # The cube-root transform turns a one-ulp float32 difference near 1.0 into
+        # almost a whole point, so accumulate the products exactly in float64 and
+        # round once to float32, matching calculate_similarity bit for bit
+        cosine = (embeddings[rows] @ embeddings.T).astype(np.float32)
+        return np.rint(self._transform_similarity(cosine) * 100).astype(np.uint8)
+
+    @staticmethod
+    def _symmetrize(scores: np.ndarray) -> np.ndarray:
+        # Mirror the upper triangle so the result is exactly symmetric
+        lower = np.tril_indices(len(scores), -1)
+        scores[lower] = scores.T[lower]
+        np.fill_diagonal(scores, 100)
+        return scores
+
+    def compute_similarity_scores(self, codes: List[str]) -> np.ndarray:
+        """Compute the symmetric 0-100 similarity matrix with a single matrix product."""
+        if not codes:
+            return np.zeros((0, 0), dtype=np.uint8)
+
+        embeddings = self.get_embedding_matrix(codes)
+        return self._symmetrize(self._score_rows(embeddings, slice(None)))
+
+    def iter_similarity_rows(
+        self, codes: List[str], block_size: int = 32
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yield (index, row) pairs of the similarity matrix one row block at a time."""
+        if not codes:
+            return
+
+        embeddings = self.get_embedding_matrix(codes)
+        for start in range(0, len(codes), block_size):
+            block = self._score_rows(embeddings, slice(start, start + block_size))
+            for offset, row in enumerate(block):
+                row[start + offset] = 100
+                yield start + offset, row
+
+    def update_similarity_scores(
+        self,
+        codes: List[str],
+        snippet_ids: List[str],
+        previous: Optional[Dict] = None,
+        progress: Optional[Callable[[str, int, int], None]] = None,
+        block_size: int = 32,
+    ) -> Tuple[np.ndarray, Dict]:
+        """Recompute only the rows of snippets added or changed since ``previous``.
+
+        ``previous`` is the state returned by an earlier call for the same
+        query. Cells between unchanged snippets are copied over, removed
+        snippets simply drop out, and the returned state covers ``codes``.
+        ``progress(stage, done, total)`` is called as embeddings are encoded
+        (stage "embeddings") and as blocks of rows are scored ("rows").
+        """
+        digests = [self.embedding_key(self._model_text(code)) for code in codes]
+        state = {"ids": list(snippet_ids), "digests": digests}
+
+        n = len(codes)
+        scores = np.zeros((n, n), dtype=np.uint8)
+        reused, fresh = [], []
+        if previous is not None:
+            previous_index = {sid: k for k, sid in enumerate(previous["ids"])}
+            for i, (sid, digest) in enumerate(zip(snippet_ids, digests)):
+                k = previous_index.get(sid)
+                if k is not None and previous["digests"][k] == digest:
+                    reused.append(i)
+                else:
+                    fresh.append(i)
+        else:
+            fresh = list(range(n))
+
+        if reused:
+            old = [previous_index[snippet_ids[i]] for i in reused]
+            scores[np.ix_(reused, reused)] = previous["scores"][np.ix_(old, old)]
+
+        if fresh:
+            if progress is not None:
+                # Encode in chunks first so progress moves; the matrix below
+                # is then gathered from the cache
+                chunk = 4 * self.max_batch_size
+                for start in range(0, n, chunk):
+                    self.get_embeddings(codes[start : start + chunk])
+                    progress("embeddings", min(start + chunk, n), n)
+            embeddings = self.get_embedding_matrix(codes)
+
+            for start in range(0, len(fresh), block_size):
+                rows = fresh[start : start + block_size]
+                block = self._score_rows(embeddings, rows)
+                scores[rows, :] = block
+                if reused:
+                    scores[np.ix_(reused, rows)] = block[:, reused].T
+                if progress is not None:
+                    progress("rows", start + len(rows), len(fresh))
+        elif progress is not None:
+            # Every row was reused: nothing to encode or score
+            progress("embeddings", n, n)
+            progress("rows", n, n)
+
+        state["scores"] = self._symmetrize(scores)
+        state["recomputed"] = len(fresh)
+        return state["scores"], state
 
     def compute_similarity_matrix(
-        self, snippets: List[SnippetInfo]
+        self, snippets: List[SnippetInfo], vectorized: bool = True
     ) -> Tuple[List[List[float]], List[Dict]]:
         """Compute similarity matrix for multiple code snippets."""
         codes = [s.code for s in snippets]
-        n = len(codes)
-        matrix = [[0.0] * n for _ in range(n)]
-
-        for i in range(n):
-            for j in range(i, n):
-                matrix[i][j] = matrix[j][i] = (
-                    100
-                    if i == j
-                    else round(self.calculate_similarity(codes[i], codes[j]) * 100)
-                )
 
-        snippet_info = [
-            {
+        if vectorized:
+            matrix = self.compute_similarity_scores(codes).tolist()
+        else:
+            # Pairwise reference path
+            n = len(codes)
+            matrix = [[0.0] * n for _ in range(n)]
+
+            # Encode every snippet up front so the pair loop only hits the cache
+            self.get_embeddings(codes)
+
+            for i in range(n):
+                for j in range(i, n):
+                    matrix[i][j] = matrix[j][i] = (
+                        100
+                        if i == j
+                        else round(self.calculate_similarity(codes[i], codes[j]) * 100)
+                    )
+
+        return matrix, self.describe_snippets(snippets)
+
+    def describe_snippets(
+        self, snippets: List[SnippetInfo], include_code: bool = True
+    ) -> List[Dict]:
+        """Snippet metadata returned alongside a similarity matrix."""
+        snippet_info = []
+        for s in snippets:
+            info = {
                 "learner": s.learner,
                 "learner_id": s.learner_id,
                 "fileName": s.file_name,
-                "code": s.code,
                 "timestamp": str(s.timestamp),
+                "submission_id": s.submission_id,
             }
-            for s in snippets
-        ]
-        return matrix, snippet_info
+            if include_code:
+                info["code"] = s.code
+            snippet_info.append(info)
+        return snippet_info
+
+    def similarity_edges(
+        self, scores: np.ndarray, top_k: Optional[int] = None, min_score: int = 0
+    ) -> List[List[int]]:
+        """Sparse [i, j, score] edges (i < j) of a similarity matrix.
+
+        A pair is kept when its score is at least ``min_score`` and, if
+        ``top_k`` is given, it is among the ``top_k`` best matches of either
+        snippet.
+        """
+        n = len(scores)
+        if n < 2:
+            return []
+
+        candidates = scores.astype(np.int16)
+        np.fill_diagonal(candidates, -1)
+        keep = candidates >= min_score
+
+        if top_k is not None and top_k < n - 1:
+            best = np.argpartition(-candidates, top_k - 1, axis=1)[:, :top_k]
+            in_top_k = np.zeros_like(keep)
+            np.put_along_axis(in_top_k, best, True, axis=1)
+            keep &= in_top_k
+
+        rows, cols = np.nonzero(np.triu(keep | keep.T, 1))
+        return np.column_stack([rows, cols, scores[rows, cols]]).tolist()
 
     def compute_sequential_similarities(
         self, snapshots: List[Dict]
     ) -> List[SequentialSimilarity]:
         """Compute sequential similarities between consecutive snapshots."""
         similarities = []
+        self.get_embeddings([snapshot["code"] for snapshot in snapshots])
         for i in range(len(snapshots) - 1):
             score = self.calculate_similarity(
                 snapshots[i]["code"], snapshots[i + 1]["code"]
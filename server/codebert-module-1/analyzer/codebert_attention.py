@@ -1,5 +1,4 @@
 import torch
-from transformers import RobertaTokenizer, RobertaModel
 import numpy as np
 from typing import Dict, List, Tuple
 import matplotlib
@@ -10,20 +9,17 @@ import io
 import base64
 import json
 import traceback
+from .model_registry import default_device, get_model, get_tokenizer
 
 
 class CodeBERTAttentionAnalyzer:
     def __init__(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = default_device()
         print(f"Using device: {self.device}")
 
-        # Configure model to output attention
-        self.model = RobertaModel.from_pretrained(
-            "microsoft/codebert-base", output_attentions=True, add_pooling_layer=False
-        ).to(self.device)
-
-        self.tokenizer = RobertaTokenizer.from_pretrained("microsoft/codebert-base")
-        self.model.eval()
+        # Shared model; attention outputs are requested per call
+        self.model = get_model("microsoft/codebert-base", self.device)
+        self.tokenizer = get_tokenizer("microsoft/codebert-base")
         print("CodeBERT attention analyzer initialized")
 
     def get_attention_maps(self, code1: str, code2: str) -> Dict:
@@ -0,0 +1,30 @@
+"""Code corpora for the offline scripts (fit_line_projection.py, quantization_report.py)."""
+import json
+import os
+
+SOURCE_EXTENSIONS = (".java", ".py", ".cpp", ".c", ".js", ".ts")
+
+
+def load_corpus(path, limit=None):
+    """Read the codes of a corpus, at most ``limit`` of them.
+
+    The corpus is either a directory of source files (searched recursively, in
+    path order) or a JSON file holding a list of code strings or of objects
+    with a "code" field.
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+            if name.endswith(SOURCE_EXTENSIONS)
+        )
+        codes = []
+        for file_path in files[:limit]:
+            with open(file_path, encoding="utf-8", errors="replace") as f:
+                codes.append(f.read())
+        return codes
+
+    with open(path, encoding="utf-8") as f:
+        items = json.load(f)
+    return [item["code"] if isinstance(item, dict) else item for item in items[:limit]]
@@ -0,0 +1,152 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from typing import Dict, List, Optional
+
+# Default byte budgets per namespace. Per-line embeddings get their own pool
+# so a large structural visualization cannot flush whole-snippet vectors.
+DEFAULT_CACHE_BUDGETS = {
+    "snippet": 64 * 1024 * 1024,
+    "line": 16 * 1024 * 1024,
+}
+
+
+class _ArenaNamespace:
+    """LRU slot index over one preallocated, contiguous (capacity, dim) arena."""
+
+    def __init__(self, budget_bytes: int, dtype: np.dtype):
+        self.budget_bytes = budget_bytes
+        self.dtype = dtype
+        self.arena: Optional[np.ndarray] = None
+        self.slots: "OrderedDict[str, int]" = OrderedDict()
+        self.next_slot = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def allocate(self, dim: int):
+        # The arena is sized on first insert, once the embedding width is known
+        capacity = self.budget_bytes // (dim * self.dtype.itemsize)
+        self.arena = np.empty((capacity, dim), dtype=self.dtype)
+
+    def acquire_slot(self) -> Optional[int]:
+        if self.next_slot < len(self.arena):
+            # Hand out fresh slots in order so a batch lands contiguously
+            self.next_slot += 1
+            return self.next_slot - 1
+        if not self.slots:
+            return None
+        _, slot = self.slots.popitem(last=False)
+        self.evictions += 1
+        return slot
+
+    def stats(self) -> Dict:
+        capacity = 0 if self.arena is None else len(self.arena)
+        row_bytes = 0 if self.arena is None else self.arena[0:1].nbytes
+        return {
+            "entries": len(self.slots),
+            "capacity": capacity,
+            "bytes": len(self.slots) * row_bytes,
+            "budget_bytes": self.budget_bytes,
+            "dtype": self.dtype.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class EmbeddingCache:
+    """Thread-safe LRU embedding cache with a byte budget per namespace.
+
+    Each namespace keeps its vectors in one contiguous arena (float32 by
+    default, optionally float16) addressed through a slot index, so a room's
+    embeddings can be gathered into a matrix without per-vector objects.
+    """
+
+    def __init__(
+        self, budgets: Optional[Dict[str, int]] = None, dtype: str = "float32"
+    ):
+        budgets = budgets or DEFAULT_CACHE_BUDGETS
+        self.dtype = np.dtype(dtype)
+        self._namespaces = {
+            name: _ArenaNamespace(budget, self.dtype)
+            for name, budget in budgets.items()
+        }
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[np.ndarray]:
+        """Return a float32 copy of the cached vector and mark it most recently used."""
+        with self._lock:
+            ns = self._namespaces[namespace]
+            slot = ns.slots.get(key)
+            if slot is None:
+                ns.misses += 1
+                return None
+            ns.slots.move_to_end(key)
+            ns.hits += 1
+            return ns.arena[slot].astype(np.float32)
+
+    def put(self, namespace: str, key: str, embedding: np.ndarray) -> np.ndarray:
+        """Insert a vector, evicting the least recently used slot when full.
+
+        Returns the vector as stored (after any float16 rounding) so callers
+        see exactly what later cache hits will return.
+        """
+        with self._lock:
+            ns = self._namespaces[namespace]
+            if ns.arena is None:
+                ns.allocate(embedding.shape[-1])
+
+            slot = ns.slots.get(key)
+            if slot is None:
+                slot = ns.acquire_slot()
+                if slot is None:
+                    # Budget too small for even one vector
+                    return embedding
+            ns.slots[key] = slot
+            ns.slots.move_to_end(key)
+            ns.arena[slot] = embedding
+            return ns.arena[slot].astype(np.float32)
+
+    def gather(
+        self, namespace: str, keys: List[str], dtype: np.dtype = np.float64
+    ) -> Optional[np.ndarray]:
+        """Return the cached vectors for keys as one (len(keys), dim) matrix.
+
+        The result is always a ``dtype`` copy made under the lock, so later
+        inserts cannot change it; a contiguous ascending run of slots is
+        converted straight out of the arena without an intermediate gather.
+        Returns None if any key is missing.
+        """
+        with self._lock:
+            ns = self._namespaces[namespace]
+            if ns.arena is None or not keys:
+                return None
+            slots = []
+            for key in keys:
+                slot = ns.slots.get(key)
+                if slot is None:
+                    return None
+                slots.append(slot)
+
+            first = slots[0]
+            if slots == list(range(first, first + len(slots))):
+                rows = ns.arena[first : first + len(slots)]
+            else:
+                rows = ns.arena[slots]
+            return rows.astype(dtype)
+
+    def clear(self):
+        with self._lock:
+            for ns in self._namespaces.values():
+                ns.slots.clear()
+                ns.next_slot = 0
+
+    def stats(self) -> Dict[str, Dict]:
+        """Hit/miss/eviction counters and memory use for every namespace."""
+        with self._lock:
+            return {name: ns.stats() for name, ns in self._namespaces.items()}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(ns.slots) for ns in self._namespaces.values())
@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+class EmbeddingDispatcher:
+    """Merge embedding requests from concurrent callers into shared batches.
+
+    Each ``embed`` call queues its texts and blocks on a future. A single
+    worker thread takes the first pending request, keeps collecting for up to
+    ``max_wait_ms`` or until ``max_batch_texts`` texts are queued, encodes
+    the distinct texts with one ``encode`` call and resolves every future.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], List[np.ndarray]],
+        max_wait_ms: float = 5.0,
+        max_batch_texts: int = 64,
+    ):
+        self.encode = encode
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_texts = max_batch_texts
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        """Encode texts as part of the next shared batch and wait for the result."""
+        if not texts:
+            return []
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        # Started lazily so the thread is created after a gunicorn fork
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="embedding-dispatcher", daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self) -> List[tuple]:
+        pending = [self._queue.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_texts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(request)
+            count += len(request[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+
+            # Callers often share snippets (e.g. the same reference solution)
+            index: Dict[str, int] = {}
+            for texts, _ in pending:
+                for text in texts:
+                    index.setdefault(text, len(index))
+
+            try:
+                embeddings = self.encode(list(index))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.requests += len(pending)
+            for texts, future in pending:
+                future.set_result([embeddings[index[text]] for text in texts])
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "queued": self._queue.qsize(),
+        }
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+from typing import Dict, Iterable
+
+
+class EmbeddingStore:
+    """On-disk embedding store shared by every worker process on the host.
+
+    Vectors are stored as float32 blobs under a content digest computed by the
+    caller, so entries survive restarts and are never tied to a process.
+    """
+
+    # Stay well below SQLite's bound-parameter limit
+    _CHUNK_SIZE = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Opened lazily per process: gunicorn builds the analyzer in the
+        # master, and SQLite connections must not be carried across fork
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return this process's connection, opening it on first use."""
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+
+            # WAL lets several gunicorn workers read while one of them writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    vector BLOB NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Return the stored vectors for whichever keys are present."""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self._CHUNK_SIZE):
+                chunk = keys[start : start + self._CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection().execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                )
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, vectors: Dict[str, np.ndarray], version: int):
+        """Insert or replace vectors in a single transaction."""
+        rows = [
+            (key, version, np.asarray(vector, dtype=np.float32).tobytes())
+            for key, vector in vectors.items()
+        ]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, version, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+    def prune(self, version: int) -> int:
+        """Delete entries written under any other preprocessing version."""
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "DELETE FROM embeddings WHERE version != ?", (version,)
+            )
+            conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            # A connection inherited from the parent is left for it to close
+            if self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+            self._pid = None
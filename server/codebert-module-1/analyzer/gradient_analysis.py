@@ -8,16 +8,18 @@ import matplotlib.gridspec as gridspec
 import io
 import base64
 import traceback
-from transformers import RobertaModel, RobertaTokenizer
 from .codebert_analyzer import CodeBERTAnalyzer
+from .model_registry import default_device, get_model, get_tokenizer
 
 
 class GradientAnalysis:
     def __init__(self):
         self.analyzer = CodeBERTAnalyzer()
-        self.model = self.analyzer.model
-        self.tokenizer = self.analyzer.tokenizer
-        self.device = self.analyzer.device
+        # Gradients need the fp32 torch model whatever the embedding backend
+        # (onnx) or quantization is, so take it from the registry directly
+        self.device = default_device()
+        self.model = get_model(self.analyzer.model_name, self.device)
+        self.tokenizer = get_tokenizer(self.analyzer.model_name)
         self.preprocess_code = self.analyzer.preprocess_code
 
     def analyze_embedding_gradients(self, code1: str, code2: str) -> dict:
@@ -25,8 +27,8 @@ class GradientAnalysis:
         try:
             print("Starting gradient analysis...")
 
-            # Enable gradient tracking and train mode
-            self.model.train()
+            # Enable gradient tracking. The model is shared and stays in eval
+            # mode; gradients are only taken w.r.t. the pooled embeddings.
             torch.set_grad_enabled(True)
 
             # Process inputs
@@ -57,10 +59,6 @@ class GradientAnalysis:
             emb1 = outputs1.last_hidden_state.mean(dim=1)
             emb2 = outputs2.last_hidden_state.mean(dim=1)
 
-            # Important: Retain gradients for non-leaf tensors
-            emb1.retain_grad()
-            emb2.retain_grad()
-
             # Create leaf tensors for gradient computation
             emb1_leaf = emb1.clone().detach().requires_grad_(True)
             emb2_leaf = emb2.clone().detach().requires_grad_(True)
@@ -216,8 +214,7 @@ class GradientAnalysis:
             plt.close("all")
             buf.seek(0)
 
-            # Reset model state
-            self.model.eval()
+            # Reset gradient tracking
             torch.set_grad_enabled(False)
 
             print("Analysis completed successfully")
@@ -0,0 +1,105 @@
+"""Linear 2-D projections of line embeddings for the structure visualizations.
+
+Shared by codebert-module-1 and Docker/flask, which ships this file next to
+its copy of codebert_analyzer.py. The "global" artifact is written by
+fit_line_projection.py.
+"""
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+# "independent" embeds every line as its own snippet; "contextual" encodes the
+# whole snippet once and pools token states per line
+LINE_MODES = ("independent", "contextual")
+
+# "pca" projects onto the top two principal axes of the request's own lines,
+# "global" onto axes fitted once on a corpus of lines (fit_line_projection.py)
+# and "umap" fits UMAP per request, which is much slower
+PROJECTION_ENGINES = ("pca", "global", "umap")
+
+# DBSCAN radius per engine. UMAP lays points out on its own scale; the linear
+# projections are rescaled to unit RMS spread before clustering
+DBSCAN_EPS = {"pca": 0.35, "global": 0.35, "umap": 1.2}
+
+
+def default_projection() -> str:
+    """Engine used when a request names none (STRUCTURE_PROJECTION).
+
+    Read per call rather than at import, so a .env loaded after this module
+    is imported still applies.
+    """
+    return os.getenv("STRUCTURE_PROJECTION", "pca")
+
+
+def global_projection_path() -> Optional[str]:
+    """Artifact written by fit_line_projection.py (STRUCTURE_PROJECTION_PATH)."""
+    return os.getenv("STRUCTURE_PROJECTION_PATH")
+
+
+def fit_pca(embeddings: np.ndarray, n_components: int = 2):
+    """Return the mean and the top principal axes of the rows."""
+    data = np.asarray(embeddings, dtype=np.float64)
+    mean = data.mean(axis=0)
+    _, _, vt = np.linalg.svd(data - mean, full_matrices=False)
+    components = vt[:n_components]
+
+    # SVD may return either sign for an axis; make the largest loading positive
+    largest = components[np.arange(len(components)), np.abs(components).argmax(axis=1)]
+    components = components * np.where(largest < 0, -1.0, 1.0)[:, None]
+
+    if len(components) < n_components:
+        padding = np.zeros((n_components - len(components), data.shape[1]))
+        components = np.vstack([components, padding])
+    return mean, components
+
+
+def linear_projection(
+    embeddings: np.ndarray, mean: np.ndarray, components: np.ndarray
+) -> np.ndarray:
+    """Project rows onto components, centred and scaled to unit RMS spread."""
+    coords = (np.asarray(embeddings, dtype=np.float64) - mean) @ components.T
+    coords -= coords.mean(axis=0)
+    spread = np.sqrt((coords**2).sum(axis=1).mean())
+    return coords / spread if spread > 0 else coords
+
+
+@lru_cache(maxsize=4)
+def _read_global_projection(path: str):
+    with np.load(path) as data:
+        return data["mean"], data["components"], str(data["line_mode"])
+
+
+def load_global_projection(path: str, line_mode: Optional[str] = None):
+    """Load the mean and axes saved by fit_line_projection.py.
+
+    With ``line_mode``, raises ValueError if the artifact was fitted on line
+    embeddings of the other mode: its axes would still apply without error,
+    but to vectors from a different distribution.
+    """
+    mean, components, fitted_mode = _read_global_projection(path)
+    if line_mode is not None and line_mode != fitted_mode:
+        raise ValueError(
+            f"The global projection in {path} was fitted for lineMode "
+            f"{fitted_mode!r}, not {line_mode!r}"
+        )
+    return mean, components
+
+
+def check_structure_options(line_mode: str, projection: Optional[str]) -> str:
+    """Validate the line mode and projection engine; returns the engine to use.
+
+    Raises ValueError naming the accepted values, or if the global projection
+    is selected but missing or fitted for the other line mode.
+    """
+    if line_mode not in LINE_MODES:
+        raise ValueError(f"lineMode must be one of {', '.join(LINE_MODES)}")
+    projection = projection or default_projection()
+    if projection not in PROJECTION_ENGINES:
+        raise ValueError(f"projection must be one of {', '.join(PROJECTION_ENGINES)}")
+    if projection == "global":
+        if not global_projection_path():
+            raise ValueError("The global projection needs STRUCTURE_PROJECTION_PATH")
+        load_global_projection(global_projection_path(), line_mode)
+    return projection
@@ -0,0 +1,104 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+# One RoBERTa copy per (name, device, config) for the whole process. Every
+# analyzer gets the same instance, so they must treat it as read-only: no
+# train() toggling and no parameter updates. Attention maps are requested per
+# call with ``output_attentions=True`` rather than baked into the config.
+#
+# torch, transformers and onnxruntime are imported on first use so an
+# ONNX-only deployment never loads torch through this module.
+_lock = threading.Lock()
+_models: Dict[Tuple, Any] = {}
+_tokenizers: Dict[Tuple[str, bool], Any] = {}
+_sessions: Dict[Tuple, Any] = {}
+
+
+def default_device():
+    import torch
+
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_tokenizer(name: str, fast: bool = False):
+    """Return the shared tokenizer for a model name, loading it on first use.
+
+    ``fast=True`` returns the Rust tokenizer, which can report the character
+    offsets of every token.
+    """
+    from transformers import RobertaTokenizer, RobertaTokenizerFast
+
+    with _lock:
+        tokenizer = _tokenizers.get((name, fast))
+        if tokenizer is None:
+            tokenizer_class = RobertaTokenizerFast if fast else RobertaTokenizer
+            tokenizer = tokenizer_class.from_pretrained(name)
+            _tokenizers[(name, fast)] = tokenizer
+        return tokenizer
+
+
+QUANTIZATION_MODES = (None, "int8")
+
+
+def get_model(
+    name: str,
+    device=None,
+    quantization: Optional[str] = None,
+    **config,
+):
+    """Return the shared eval-mode model for a name and config, loading it on first use.
+
+    ``config`` is passed to ``from_pretrained`` and is part of the registry
+    key, so analyzers asking for the same options share one copy.
+    ``quantization="int8"`` applies dynamic int8 quantization to the Linear
+    layers, which only runs on CPU.
+    """
+    import torch
+    from transformers import RobertaModel
+
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {quantization}")
+    device = device or default_device()
+    if quantization is not None and device.type != "cpu":
+        raise ValueError("Dynamic quantization is only supported on CPU")
+
+    key = (name, str(device), quantization, tuple(sorted(config.items())))
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            model = RobertaModel.from_pretrained(name, **config)
+            model.to(device)
+            model.eval()
+            # Inference only; also keeps autograd from tracing the weights
+            model.requires_grad_(False)
+            if quantization == "int8":
+                # Weights become int8, activations are quantized per batch
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            _models[key] = model
+        return model
+
+
+
+def get_onnx_session(path: str, intra_op_threads: int = 0):
+    """Return the shared onnxruntime CPU session for an exported encoder.
+
+    ``intra_op_threads`` of 0 leaves the thread count to onnxruntime.
+    """
+    import onnxruntime
+
+    key = (path, intra_op_threads)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = intra_op_threads
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            )
+            session = onnxruntime.InferenceSession(
+                path, options, providers=["CPUExecutionProvider"]
+            )
+            _sessions[key] = session
+        return session
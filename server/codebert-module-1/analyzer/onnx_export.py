@@ -0,0 +1,119 @@
+"""Export the CodeBERT encoder with mean pooling to ONNX.
+
+The graph takes ``input_ids`` and ``attention_mask`` (int64, batch x
+sequence, both axes dynamic) and returns ``embeddings``, the masked mean of
+the last hidden states before normalization, exactly what
+``CodeBERTAnalyzer`` computes with torch. Point the analyzer at the file with
+``backend="onnx"`` / ``EMBEDDING_BACKEND=onnx`` and ``ONNX_MODEL_PATH``.
+
+    python -m analyzer.onnx_export codebert.onnx
+    python -m analyzer.onnx_export codebert.onnx --model microsoft/codebert-base --check
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+from transformers import RobertaModel, RobertaTokenizer
+
+
+class MeanPooledEncoder(torch.nn.Module):
+    """RoBERTa encoder followed by mean pooling over the attention mask."""
+
+    def __init__(self, model: RobertaModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.model(
+            input_ids=input_ids, attention_mask=attention_mask
+        ).last_hidden_state
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        return (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+def export_onnx(model_name: str, output_path: str, opset: int = 17) -> str:
+    """Write the pooled encoder for ``model_name`` to ``output_path``."""
+    # Eager attention traces to plain ops that every onnxruntime build supports
+    model = RobertaModel.from_pretrained(model_name, attn_implementation="eager")
+    model.eval()
+    tokenizer = RobertaTokenizer.from_pretrained(model_name)
+
+    sample = tokenizer(
+        ["int main() { return 0; }", "print(sum(range(10)))"],
+        padding=True,
+        return_tensors="pt",
+    )
+    with torch.no_grad():
+        torch.onnx.export(
+            MeanPooledEncoder(model),
+            (sample["input_ids"], sample["attention_mask"]),
+            output_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "embeddings": {0: "batch"},
+            },
+            opset_version=opset,
+            dynamo=False,
+        )
+    return output_path
+
+
+def check_export(
+    model_name: str, output_path: str, codes, embedding_mode: str = "truncate"
+) -> float:
+    """Largest cosine distance between torch and onnxruntime embeddings of codes."""
+    from .codebert_analyzer import CodeBERTAnalyzer
+
+    # Pin what EMBEDDING_* variables would otherwise choose, so the reference
+    # is the plain fp32 encoder and only the backend differs
+    settings = dict(
+        model_path=model_name,
+        cache_dtype="float32",
+        embedding_mode=embedding_mode,
+        quantization="none",
+        micro_batch_ms=0,
+    )
+    reference = CodeBERTAnalyzer(backend="torch", **settings)
+    exported = CodeBERTAnalyzer(backend="onnx", onnx_path=output_path, **settings)
+    expected = np.stack(reference.get_embeddings(codes))
+    actual = np.stack(exported.get_embeddings(codes))
+    return float(np.max(1 - np.sum(expected * actual, axis=1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="path of the .onnx file to write")
+    parser.add_argument("--model", default="microsoft/codebert-base")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument(
+        "--check", action="store_true", help="compare against torch after exporting"
+    )
+    parser.add_argument(
+        "--embedding-mode",
+        choices=("truncate", "sliding_window"),
+        default="truncate",
+        help="embedding mode of both sides of --check",
+    )
+    args = parser.parse_args()
+
+    export_onnx(args.model, args.output, args.opset)
+    print(f"Exported {args.model} to {args.output}")
+
+    if args.check:
+        # Compare fresh encodes rather than vectors from a persistent store
+        os.environ.pop("EMBEDDING_STORE_PATH", None)
+        codes = [
+            "int main() { int x = 0; for (int i = 0; i < 10; i++) x += i; return x; }",
+            "def add(a, b):\n    return a + b",
+            "public class Main { public static void main(String[] a) {} }" * 40,
+        ]
+        distance = check_export(args.model, args.output, codes, args.embedding_mode)
+        print(f"Max cosine distance vs torch: {distance:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,15 @@ import io
 import base64
 import random
 import torch
+from typing import Optional
+from .line_projection import (
+    DBSCAN_EPS,
+    check_structure_options,
+    fit_pca,
+    global_projection_path,
+    linear_projection,
+    load_global_projection,
+)
 from .codebert_analyzer import CodeBERTAnalyzer
 
 # Set environment variables for deterministic behavior
@@ -33,17 +42,22 @@ class StructuralAnalysis:
         if torch.cuda.is_available():
             torch.cuda.manual_seed_all(42)
 
-    def get_embedding(self, line):
+    def get_embedding(self, line, namespace="line"):
         # Use the analyzer's embedding method with preprocessing
         preprocessed_line = self.analyzer.preprocess_code(line)
-        return self.analyzer.get_embedding(preprocessed_line)
+        return self.analyzer.get_embedding(preprocessed_line, namespace)
 
-    def calculate_similarity(self, code1, code2):
+    def get_embeddings(self, lines, namespace="line"):
+        # Preprocess every line, then embed them in batched forward passes
+        preprocessed_lines = [self.analyzer.preprocess_code(line) for line in lines]
+        return self.analyzer.get_embeddings(preprocessed_lines, namespace)
+
+    def calculate_similarity(self, code1, code2, namespace="snippet"):
         # Use the analyzer's preprocessing and similarity calculation
         preprocessed_code1 = self.analyzer.preprocess_code(code1)
         preprocessed_code2 = self.analyzer.preprocess_code(code2)
         return self.analyzer.calculate_similarity(
-            preprocessed_code1, preprocessed_code2
+            preprocessed_code1, preprocessed_code2, namespace
         )
 
     def infer_code_structure_type(self, code_lines: list[str]) -> str:
@@ -157,19 +171,42 @@ class StructuralAnalysis:
 
     def get_line_embeddings(self, code_snippet: str) -> tuple[np.ndarray, list[str]]:
         """Get embeddings for each non-empty line in the code snippet."""
-        lines = code_snippet.split("\n")
-        embeddings = []
-        valid_lines = []
-
-        for line in lines:
-            if not line.strip():
-                continue
-            emb = self.get_embedding(line)
-            embeddings.append(emb)
-            valid_lines.append(line)
+        valid_lines = [line for line in code_snippet.split("\n") if line.strip()]
+        embeddings = (
+            self.get_embeddings(valid_lines, namespace="line") if valid_lines else []
+        )
 
+        # Convert to numpy array only at the end to avoid intermediate copies
         return np.array(embeddings), valid_lines
 
+    def get_contextual_line_embeddings(
+        self, code_snippet: str
+    ) -> tuple[np.ndarray, list[str]]:
+        """Get embeddings for each non-empty line from one pass over the whole snippet."""
+        return self.analyzer.get_contextual_line_embeddings(code_snippet)
+
+    def get_pair_line_embeddings(
+        self, code_a: str, code_b: str, line_mode: str = "independent"
+    ) -> tuple[np.ndarray, list[str], np.ndarray, list[str]]:
+        """Get line embeddings for two snippets with one batched embedding call.
+
+        Lines shared by both snippets (braces, ``return x;``...) are encoded
+        once; the vectors match ``get_line_embeddings`` on each snippet. In
+        "contextual" mode each snippet is instead encoded whole, once.
+        """
+        if line_mode == "contextual":
+            embeddings_a, lines_a = self.get_contextual_line_embeddings(code_a)
+            embeddings_b, lines_b = self.get_contextual_line_embeddings(code_b)
+            return embeddings_a, lines_a, embeddings_b, lines_b
+
+        lines_a = [line for line in code_a.split("\n") if line.strip()]
+        lines_b = [line for line in code_b.split("\n") if line.strip()]
+        lines = lines_a + lines_b
+        embeddings = np.array(
+            self.get_embeddings(lines, namespace="line") if lines else []
+        )
+        return embeddings[: len(lines_a)], lines_a, embeddings[len(lines_a) :], lines_b
+
     def get_line_positions(self, code: str) -> list[dict]:
         """Get the start and end positions of each line in the code."""
         positions = []
@@ -188,10 +225,16 @@ class StructuralAnalysis:
         
         return positions
 
-    def enrich_similar_structures(self, code_a: str, code_b: str, similar_structures: list[dict]) -> list[dict]:
-        """Enrich similar structures with line positions and detailed similarity info."""
-        positions_a = self.get_line_positions(code_a)
-        positions_b = self.get_line_positions(code_b)
+    def enrich_similar_structures(self, code_a: str, code_b: str, similar_structures: list[dict], line_vectors: Optional[dict] = None) -> list[dict]:
+        """Enrich similar structures with line positions and detailed similarity info.
+
+        ``line_vectors`` maps a cluster id to the embeddings of its code_a and
+        code_b lines, as computed for the projection; clusters without an
+        entry have their lines embedded here.
+        """
+        line_vectors = line_vectors or {}
+        positions_a = self._positions_by_content(code_a)
+        positions_b = self._positions_by_content(code_b)
         
         enriched_structures = []
         for structure in similar_structures:
@@ -199,32 +242,41 @@ class StructuralAnalysis:
             lines_a = structure['code_a']
             lines_b = structure['code_b']
             
-            # Find positions in original code
-            matched_positions_a = []
-            matched_positions_b = []
+            # Every position whose content matches, for each line in order
+            matched_positions_a = [pos for line in lines_a for pos in positions_a.get(line.strip(), [])]
+            matched_positions_b = [pos for line in lines_b for pos in positions_b.get(line.strip(), [])]
             
-            for line in lines_a:
-                for pos in positions_a:
-                    if pos['content'].strip() == line.strip():
-                        matched_positions_a.append(pos)
+            # Line pairs are taken in order up to the shorter of lines/positions
+            count_a = min(len(lines_a), len(matched_positions_a))
+            count_b = min(len(lines_b), len(matched_positions_b))
+            vectors = line_vectors.get(structure['cluster_id'])
+            if vectors is None:
+                vectors = (
+                    np.array(self.get_embeddings(lines_a[:count_a])),
+                    np.array(self.get_embeddings(lines_b[:count_b])),
+                )
+            vectors_a, vectors_b = vectors[0][:count_a], vectors[1][:count_b]
             
-            for line in lines_b:
-                for pos in positions_b:
-                    if pos['content'].strip() == line.strip():
-                        matched_positions_b.append(pos)
+            # Calculate line-by-line similarities in one block, accumulated in
+            # float64 like calculate_similarity
+            if count_a and count_b:
+                cosine = (vectors_a.astype(np.float64) @ vectors_b.astype(np.float64).T).astype(np.float32)
+                # CombinedAnalyzer mixes this class in without an .analyzer
+                scores = getattr(self, "analyzer", self)._transform_similarity(cosine)
+            else:
+                scores = np.zeros((count_a, count_b), dtype=np.float32)
             
-            # Calculate line-by-line similarities
-            line_similarities = []
-            for line_a, pos_a in zip(lines_a, matched_positions_a):
-                line_sims = []
-                for line_b, pos_b in zip(lines_b, matched_positions_b):
-                    sim = self.calculate_similarity(line_a, line_b)
-                    line_sims.append({
-                        'similarity': float(sim),
-                        'position_a': pos_a,
-                        'position_b': pos_b
-                    })
-                line_similarities.append(line_sims)
+            line_similarities = [
+                [
+                    {
+                        'similarity': float(scores[i, j]),
+                        'position_a': matched_positions_a[i],
+                        'position_b': matched_positions_b[j]
+                    }
+                    for j in range(count_b)
+                ]
+                for i in range(count_a)
+            ]
             
             enriched_structures.append({
                 **structure,
@@ -236,15 +288,47 @@ class StructuralAnalysis:
         
         return enriched_structures
 
-    def visualize_code_similarity(self, code_snippet_a: str, code_snippet_b: str, dim: int = 2) -> tuple[str, list[dict]]:
-        """Generate visualization for code similarity between two snippets with improved readability."""
-        try:
+    def _positions_by_content(self, code: str) -> dict[str, list[dict]]:
+        """Line positions of the code grouped by stripped content, in line order."""
+        positions = {}
+        for pos in self.get_line_positions(code):
+            positions.setdefault(pos['content'].strip(), []).append(pos)
+        return positions
+
+    def project_embeddings(self, embeddings: np.ndarray, projection: str = "pca", line_mode: str = "independent") -> np.ndarray:
+        """Reduce line embeddings, built in line_mode, to 2-D with the given engine."""
+        if projection == "umap":
             # Force deterministic behavior for UMAP
             torch.use_deterministic_algorithms(True)
+            reducer = UMAP(
+                n_components=2,
+                n_neighbors=min(6, len(embeddings) - 1),
+                min_dist=1,
+                spread=1,
+                random_state=42,
+                n_jobs=1,
+            )
+            return reducer.fit_transform(embeddings)
+
+        if projection == "global":
+            mean, components = load_global_projection(
+                global_projection_path(), line_mode
+            )
+        else:
+            mean, components = fit_pca(embeddings)
+        return linear_projection(embeddings, mean, components)
+
+    def visualize_code_similarity(self, code_snippet_a: str, code_snippet_b: str, dim: int = 2, line_mode: str = "independent", projection: Optional[str] = None) -> tuple[str, list[dict]]:
+        """Generate visualization for code similarity between two snippets with improved readability."""
+        projection = check_structure_options(line_mode, projection)
 
+        try:
             # Get embeddings for both snippets
-            embeddings_a, lines_a = self.get_line_embeddings(code_snippet_a)
-            embeddings_b, lines_b = self.get_line_embeddings(code_snippet_b)
+            embeddings_a, lines_a, embeddings_b, lines_b = (
+                self.get_pair_line_embeddings(
+                    code_snippet_a, code_snippet_b, line_mode
+                )
+            )
 
             if len(embeddings_a) == 0 or len(embeddings_b) == 0:
                 raise ValueError("One or both code snippets are empty after preprocessing")
@@ -253,21 +337,12 @@ class StructuralAnalysis:
             combined_embeddings = np.vstack([embeddings_a, embeddings_b])
             labels = np.concatenate([np.zeros(len(embeddings_a)), np.ones(len(embeddings_b))])
 
-            # First apply UMAP for dimensionality reduction
-            reducer = UMAP(
-                n_components=2,
-                n_neighbors=min(6, len(combined_embeddings) - 1),
-                min_dist=1,
-                spread=1,
-                random_state=42,
-                n_jobs=1,
-            )
-
-            reduced_embeddings = reducer.fit_transform(combined_embeddings)
+            # First reduce to 2-D with the selected projection engine
+            reduced_embeddings = self.project_embeddings(combined_embeddings, projection, line_mode)
 
             # Then apply DBSCAN on reduced embeddings
             clustering = DBSCAN(
-                eps=1.2,        # Adjusted for 2D space
+                eps=DBSCAN_EPS[projection],
                 min_samples=2,
                 metric='euclidean',  # Changed to euclidean for 2D space
                 n_jobs=1,       # Single thread for determinism
@@ -309,6 +384,7 @@ class StructuralAnalysis:
 
             # Find similar structures
             similar_structures = []
+            line_vectors = {}
             for cluster_id in sorted(
                 set(cluster_labels)
             ):  # Sort for deterministic order
@@ -338,6 +414,11 @@ class StructuralAnalysis:
                             ),
                         }
                     )
+                    # Rows of df are rows of combined_embeddings
+                    line_vectors[int(cluster_id)] = (
+                        combined_embeddings[cluster_df.index[cluster_df["source"] == "Code Sample 1"]],
+                        combined_embeddings[cluster_df.index[cluster_df["source"] == "Code Sample 2"]],
+                    )
 
             # Calculate overall similarity as average of cluster similarities
             if similar_structures:
@@ -381,25 +462,30 @@ class StructuralAnalysis:
                 cluster_points = viz_df[viz_df["cluster"] == structure["cluster_id"]]
                 if len(cluster_points) >= 3:  # Need at least 3 points for ConvexHull
                     points = cluster_points[["x", "y"]].values
-                    hull = ConvexHull(points)
-                    hull_points = points[hull.vertices]
-                    
-                    # Pad the hull
-                    centroid = np.mean(hull_points, axis=0)
-                    padded_hull_points = []
-                    for point in hull_points:
-                        vector = point - centroid
-                        padded_point = centroid + vector * 1.05
-                        padded_hull_points.append(padded_point)
-                    
-                    padded_hull_points = np.array(padded_hull_points)
-                    ax.fill(
-                        padded_hull_points[:, 0],
-                        padded_hull_points[:, 1],
-                        alpha=0.3,
-                        color="gray",
-                        zorder=2,
-                    )
+                    try:
+                        hull = ConvexHull(points)
+                        hull_points = points[hull.vertices]
+                        
+                        # Pad the hull
+                        centroid = np.mean(hull_points, axis=0)
+                        padded_hull_points = []
+                        for point in hull_points:
+                            vector = point - centroid
+                            padded_point = centroid + vector * 1.05
+                            padded_hull_points.append(padded_point)
+                        
+                        padded_hull_points = np.array(padded_hull_points)
+                        ax.fill(
+                            padded_hull_points[:, 0],
+                            padded_hull_points[:, 1],
+                            alpha=0.3,
+                            color="gray",
+                            zorder=2,
+                        )
+                    except Exception:
+                        # Identical lines project onto one point, so a cluster
+                        # can be flat; skip its hull like the Docker service does
+                        pass
 
                 # Add cluster number in the center
                 centroid = (cluster_points["x"].mean(), cluster_points["y"].mean())
@@ -501,7 +587,8 @@ class StructuralAnalysis:
             enriched_structures = self.enrich_similar_structures(
                 code_snippet_a, 
                 code_snippet_b, 
-                similar_structures
+                similar_structures,
+                line_vectors
             )
             
             return f"data:image/png;base64,{img_base64}", enriched_structures
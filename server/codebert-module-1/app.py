@@ -4,6 +4,7 @@ from flask_cors import CORS
 from analyzer import CombinedAnalyzer
 from analyzer.codebert_analyzer import SnippetInfo, SequentialSimilarity
 from analyzer.codebert_attention import CodeBERTAttentionAnalyzer
+from analyzer.line_projection import check_structure_options
 from analyzer.attention import (
     CodeSimilarityAnalyzer as OriginalCodeSimilarityAnalyzer,
 )  # Renamed to avoid conflict
@@ -23,8 +24,8 @@ CORS(app)
 # Initialize the combined analyzer
 codebert_detector = CombinedAnalyzer()
 
-# Connect to MongoDB
-client = MongoClient("mongodb://127.0.0.1:27017/codec-v3")
+# Connect to MongoDB (lazily, so a gunicorn master can fork safely)
+client = MongoClient("mongodb://127.0.0.1:27017/codec-v3", connect=False)
 db = client["codec-v3"]
 userSubmissionsCollection = db["usersubmissions"]
 snapshotsCollection = db["codesnapshots"]
@@ -261,9 +262,18 @@ def visualize_similarity():
         if not code1 or not code2:
             return jsonify({"success": False, "error": "Missing code samples"}), 400
 
+        line_mode = data.get("lineMode", "independent")
+        try:
+            # Defaults to STRUCTURE_PROJECTION
+            projection = check_structure_options(line_mode, data.get("projection"))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
         print(f"Analyzing code samples: {len(code1)}, {len(code2)} chars")
 
-        image, structures = codebert_detector.visualize_code_similarity(code1, code2)
+        image, structures = codebert_detector.visualize_code_similarity(
+            code1, code2, line_mode=line_mode, projection=projection
+        )
 
         print(f"Analysis complete. Found {len(structures)} similar structures")
 
@@ -0,0 +1,63 @@
+"""Fit the global line projection used by STRUCTURE_PROJECTION=global.
+
+Embeds every non-empty line of a corpus the way /api/visualize-similarity
+does, fits the two principal axes once and saves them, so requests only pay
+for a matrix product instead of fitting a projection per pair.
+
+    python fit_line_projection.py ../../client/nextjs-codec/app/ir-plag/IR-Plag-Dataset line_projection.npz
+    python fit_line_projection.py snippets.json line_projection.npz --line-mode contextual
+
+The corpus is either a directory of source files (searched recursively) or a
+JSON file holding a list of code strings or of objects with a "code" field.
+Point STRUCTURE_PROJECTION_PATH at the output file; requests whose lineMode
+differs from --line-mode are rejected instead of projected onto these axes.
+"""
+import argparse
+
+import numpy as np
+
+from analyzer.corpus import load_corpus
+from analyzer.line_projection import LINE_MODES, fit_pca
+from analyzer.structural_analysis import StructuralAnalysis
+
+
+def embed_corpus(codes, line_mode="independent"):
+    detector = StructuralAnalysis()
+    if line_mode == "contextual":
+        blocks = [detector.get_contextual_line_embeddings(code)[0] for code in codes]
+        return np.vstack([block for block in blocks if len(block)])
+
+    # Distinct lines only, so boilerplate like "}" does not dominate the axes
+    lines = sorted(
+        {line for code in codes for line in code.split("\n") if line.strip()}
+    )
+    return np.array(detector.get_embeddings(lines, namespace="line"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="directory of source files or JSON snippet list")
+    parser.add_argument("output", help="path of the .npz file to write")
+    parser.add_argument("--line-mode", choices=LINE_MODES, default="independent")
+    parser.add_argument("--limit", type=int, help="only use the first N snippets")
+    args = parser.parse_args()
+
+    codes = load_corpus(args.corpus, args.limit)
+    embeddings = embed_corpus(codes, args.line_mode)
+    if len(embeddings) < 2:
+        parser.error("the corpus needs at least two non-empty lines")
+
+    mean, components = fit_pca(embeddings)
+    np.savez(
+        args.output,
+        mean=mean,
+        components=components,
+        line_mode=args.line_mode,
+        lines=len(embeddings),
+    )
+    print(f"Fitted on {len(embeddings)} lines from {len(codes)} snippets")
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Multi-worker gunicorn settings for the analysis service.
+
+The CodeBERT weights are loaded once in the master process before the
+workers fork, so they share the weight pages copy-on-write.
+
+    gunicorn --config gunicorn.conf.py app:app
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "127.0.0.1:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", max(1, multiprocessing.cpu_count() // 2)))
+# Sync workers: the analyzers plot through pyplot's process-global state,
+# which concurrent requests in one worker would corrupt
+worker_class = "sync"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = True
+
+# Split the cores between workers so their intra-op pools do not oversubscribe
+torch_threads = int(
+    os.getenv("TORCH_NUM_THREADS", max(1, multiprocessing.cpu_count() // workers))
+)
+os.environ.setdefault("OMP_NUM_THREADS", str(torch_threads))
+
+
+def on_starting(server):
+    # preload_app has already imported app.py in this (master) process
+    import app
+
+    app.codebert_detector._ensure_model_loaded()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    torch.set_num_threads(torch_threads)
@@ -0,0 +1,136 @@
+"""Compare int8-quantized similarity scores against the fp32 model.
+
+Scores every pair of a stored corpus with both inference modes and reports
+how far the 0-100 matrix moves, so the quantized mode can be enabled
+knowing its cost in accuracy.
+
+    python quantization_report.py ../../client/nextjs-codec/app/ir-plag/IR-Plag-Dataset
+    python quantization_report.py snippets.json --limit 200 --json
+
+The corpus is either a directory of source files (searched recursively) or a
+JSON file holding a list of code strings or of objects with a "code" field.
+"""
+import argparse
+import io
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from analyzer.codebert_analyzer import EMBEDDING_MODES, CodeBERTAnalyzer
+from analyzer.corpus import load_corpus
+
+
+def score_corpus(codes, quantization, model_path=None, embedding_mode="truncate"):
+    # Pin every setting a deployment may export, so both sides differ only
+    # in quantization
+    analyzer = CodeBERTAnalyzer(
+        model_path=model_path,
+        cache_dtype="float32",
+        embedding_mode=embedding_mode,
+        quantization=quantization,
+        backend="torch",
+        micro_batch_ms=0,
+    )
+    analyzer._ensure_model_loaded()
+
+    start = time.time()
+    embeddings = analyzer.get_embedding_matrix(codes)
+    elapsed = time.time() - start
+    scores = analyzer.compute_similarity_scores(codes)
+    return analyzer, embeddings, scores, elapsed
+
+
+def model_bytes(model):
+    # Quantized Linear weights live in packed params, not in parameters(),
+    # so measure the serialized state dict instead
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def build_report(codes, model_path=None, top_k=5, embedding_mode="truncate"):
+    fp32, emb_fp32, scores_fp32, time_fp32 = score_corpus(
+        codes, "none", model_path, embedding_mode
+    )
+    int8, emb_int8, scores_int8, time_int8 = score_corpus(
+        codes, "int8", model_path, embedding_mode
+    )
+
+    upper = np.triu_indices(len(codes), k=1)
+    drift = np.abs(scores_fp32.astype(np.int16) - scores_int8.astype(np.int16))[upper]
+    cosine = np.sum(emb_fp32 * emb_int8, axis=1)
+
+    # How many of each snippet's nearest neighbours survive quantization
+    k = min(top_k, len(codes) - 1)
+    overlap = []
+    for i in range(len(codes)):
+        row_fp32 = scores_fp32[i].astype(np.int16)
+        row_int8 = scores_int8[i].astype(np.int16)
+        row_fp32[i] = row_int8[i] = -1  # skip the snippet itself
+        nearest_fp32 = set(np.argsort(-row_fp32, kind="stable")[:k])
+        nearest_int8 = set(np.argsort(-row_int8, kind="stable")[:k])
+        overlap.append(len(nearest_fp32 & nearest_int8) / max(k, 1))
+
+    return {
+        "snippets": len(codes),
+        "pairs": int(drift.size),
+        "score_drift": {
+            "mean": round(float(drift.mean()), 3),
+            "p95": float(np.percentile(drift, 95)),
+            "p99": float(np.percentile(drift, 99)),
+            "max": int(drift.max()),
+            "pairs_over_5": int((drift > 5).sum()),
+        },
+        "embedding_cosine_min": round(float(cosine.min()), 5),
+        "top_k": k,
+        "neighbour_overlap": round(float(np.mean(overlap)), 4),
+        "embedding_seconds": {"fp32": round(time_fp32, 2), "int8": round(time_int8, 2)},
+        "model_mb": {
+            "fp32": round(model_bytes(fp32.model) / 2**20, 1),
+            "int8": round(model_bytes(int8.model) / 2**20, 1),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="directory of source files or JSON snippet list")
+    parser.add_argument("--limit", type=int, help="only use the first N snippets")
+    parser.add_argument("--model", help="model name or local path")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument(
+        "--embedding-mode", choices=EMBEDDING_MODES, default="truncate"
+    )
+    parser.add_argument("--json", action="store_true", help="print the raw report")
+    args = parser.parse_args()
+
+    # Measure the model itself, not a warm persistent store
+    os.environ.pop("EMBEDDING_STORE_PATH", None)
+
+    codes = load_corpus(args.corpus, args.limit)
+    if len(codes) < 2:
+        parser.error("the corpus needs at least two snippets")
+
+    report = build_report(codes, args.model, args.top_k, args.embedding_mode)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    drift = report["score_drift"]
+    print(f"Snippets: {report['snippets']} ({report['pairs']} pairs)")
+    print(
+        f"Score drift (points): mean {drift['mean']}, p95 {drift['p95']}, "
+        f"p99 {drift['p99']}, max {drift['max']}, >5 on {drift['pairs_over_5']} pairs"
+    )
+    print(f"Lowest fp32/int8 embedding cosine: {report['embedding_cosine_min']}")
+    print(f"Top-{report['top_k']} neighbour overlap: {report['neighbour_overlap']:.1%}")
+    seconds, size = report["embedding_seconds"], report["model_mb"]
+    print(f"Embedding time: fp32 {seconds['fp32']}s, int8 {seconds['int8']}s")
+    print(f"Model size: fp32 {size['fp32']} MB, int8 {size['int8']} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+from analyzer.codebert_analyzer import CodeBERTAnalyzer
+
+# Settings a deployment may export that would change what the analyzer builds
+ANALYZER_ENV = (
+    "EMBEDDING_BACKEND",
+    "EMBEDDING_QUANTIZATION",
+    "EMBEDDING_MODE",
+    "EMBEDDING_CACHE_DTYPE",
+    "EMBEDDING_STORE_PATH",
+    "EMBEDDING_MICRO_BATCH_MS",
+)
+
+
+def stub_vector(text: str, dim: int = 64) -> np.ndarray:
+    """Unit vector for text; texts sharing a first character nearly coincide.
+
+    The near-duplicates give cosines within a few ulps of 1.0, where the score
+    transform is most sensitive to rounding.
+    """
+
+    def seeded(seed: str) -> np.ndarray:
+        digest = hashlib.sha256(seed.encode("utf-8")).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+        return rng.standard_normal(dim)
+
+    vector = seeded(text[:1]) + 1e-3 * seeded(text)
+    return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+
+@pytest.fixture
+def stub_analyzer(monkeypatch):
+    """CodeBERTAnalyzer whose encoder is replaced by stub_vector, so no model loads."""
+    for name in ANALYZER_ENV:
+        monkeypatch.delenv(name, raising=False)
+    analyzer = CodeBERTAnalyzer(backend="torch", micro_batch_ms=0)
+    monkeypatch.setattr(
+        analyzer,
+        "_encode_texts",
+        lambda texts, stats=None: [stub_vector(text) for text in texts],
+    )
+    return analyzer
+
+
+@pytest.fixture
+def stub_codes():
+    # Families "a" and "b" are near-duplicates; the rest are unrelated
+    return [
+        "a = 1",
+        "a = 2",
+        "a = 3",
+        "b += 1",
+        "b += 2",
+        "c()",
+        "d[0]",
+        "e.f",
+        "g or h",
+        "i if j else k",
+    ]
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+from analyzer.codebert_analyzer import (
+    SnippetInfo,
+    pack_upper_triangle,
+    unpack_upper_triangle,
+)
+
+
+def test_similarity_scores_match_the_pairwise_path(stub_analyzer, stub_codes):
+    vectorized, _ = stub_analyzer.compute_similarity_matrix(
+        [snippet(code) for code in stub_codes]
+    )
+    pairwise, _ = stub_analyzer.compute_similarity_matrix(
+        [snippet(code) for code in stub_codes], vectorized=False
+    )
+
+    assert vectorized == pairwise
+    # The near-duplicates land in the steep part of the transform
+    assert 0 < vectorized[0][1] < 100
+
+
+def test_score_rows_match_calculate_similarity(stub_analyzer, stub_codes):
+    embeddings = stub_analyzer.get_embedding_matrix(stub_codes)
+    scores = stub_analyzer._score_rows(embeddings, slice(None))
+
+    for i, code_i in enumerate(stub_codes):
+        for j, code_j in enumerate(stub_codes):
+            expected = np.float32(stub_analyzer.calculate_similarity(code_i, code_j))
+            assert scores[i, j] == np.rint(expected * 100), (i, j)
+
+
+def test_incremental_update_matches_full_recompute(stub_analyzer, stub_codes):
+    ids = [f"s{i}" for i in range(len(stub_codes))]
+    first, state = stub_analyzer.update_similarity_scores(stub_codes, ids)
+    np.testing.assert_array_equal(
+        first, stub_analyzer.compute_similarity_scores(stub_codes)
+    )
+
+    # Drop one snippet, edit one, add two and reorder the rest
+    codes = stub_codes[1:] + ["a = 4", "z"]
+    codes[3] = "b += 3"
+    new_ids = ids[1:] + ["s_new1", "s_new2"]
+    order = np.random.default_rng(0).permutation(len(codes))
+    codes = [codes[i] for i in order]
+    new_ids = [new_ids[i] for i in order]
+
+    updated, new_state = stub_analyzer.update_similarity_scores(
+        codes, new_ids, previous=state
+    )
+
+    assert new_state["recomputed"] == 3
+    np.testing.assert_array_equal(
+        updated, stub_analyzer.compute_similarity_scores(codes)
+    )
+
+
+def test_update_reports_progress_when_every_row_is_reused(stub_analyzer, stub_codes):
+    ids = [f"s{i}" for i in range(len(stub_codes))]
+    _, state = stub_analyzer.update_similarity_scores(stub_codes, ids)
+    calls = []
+
+    _, new_state = stub_analyzer.update_similarity_scores(
+        stub_codes, ids, previous=state, progress=lambda *call: calls.append(call)
+    )
+
+    n = len(stub_codes)
+    assert new_state["recomputed"] == 0
+    assert calls == [("embeddings", n, n), ("rows", n, n)]
+
+
+def distinct_scores(n, seed=0):
+    """Symmetric uint8 matrix whose rows hold no tied off-diagonal scores."""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.triu_indices(n, 1)
+    scores = np.full((n, n), 100, dtype=np.uint8)
+    scores[rows, cols] = rng.choice(100, size=len(rows), replace=False)
+    scores[cols, rows] = scores[rows, cols]
+    return scores
+
+
+def reference_edges(scores, top_k=None, min_score=0):
+    n = len(scores)
+    best = [
+        sorted((j for j in range(n) if j != i), key=lambda j: -int(scores[i, j]))[
+            :top_k
+        ]
+        for i in range(n)
+    ]
+    return [
+        [i, j, int(scores[i, j])]
+        for i in range(n)
+        for j in range(i + 1, n)
+        if scores[i, j] >= min_score and (top_k is None or j in best[i] or i in best[j])
+    ]
+
+
+@pytest.mark.parametrize(
+    "top_k, min_score", [(None, 0), (None, 60), (1, 0), (3, 0), (3, 40), (20, 50)]
+)
+def test_similarity_edges_match_a_threshold_filter(stub_analyzer, top_k, min_score):
+    scores = distinct_scores(12)
+
+    edges = stub_analyzer.similarity_edges(scores, top_k=top_k, min_score=min_score)
+
+    assert edges == reference_edges(scores, top_k, min_score)
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 7])
+def test_packed_upper_triangle_round_trips(size):
+    scores = distinct_scores(size) if size > 1 else np.full((size, size), 100, np.uint8)
+
+    packed = pack_upper_triangle(scores)
+
+    assert len(packed) == size * (size - 1) // 2
+    np.testing.assert_array_equal(unpack_upper_triangle(packed, size), scores)
+
+
+def test_packed_upper_triangle_is_row_major(stub_analyzer, stub_codes):
+    scores = stub_analyzer.compute_similarity_scores(stub_codes)
+    packed = np.frombuffer(pack_upper_triangle(scores), dtype=np.uint8)
+
+    expected = [
+        scores[i, j] for i in range(len(scores)) for j in range(i + 1, len(scores))
+    ]
+    assert packed.tolist() == expected
+
+
+def snippet(code):
+    return SnippetInfo(
+        learner="learner",
+        learner_id="id",
+        code=code,
+        timestamp="",
+        submission_id=code,
+        file_name="main.py",
+    )
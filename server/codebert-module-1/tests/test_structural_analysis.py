@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from analyzer import CombinedAnalyzer
+
+
+@pytest.fixture(scope="module")
+def combined():
+    # The model is only loaded on first use, which these tests never reach
+    return CombinedAnalyzer()
+
+
+def test_enrich_similar_structures_through_combined_analyzer(combined):
+    code_a = "int x = 0;\nreturn x;"
+    code_b = "int y = 0;\n\nreturn y;"
+    structures = [
+        {
+            "cluster_id": 0,
+            "type": "Variable Assignment",
+            "similarity": 0.9,
+            "code_a": ["int x = 0;", "return x;"],
+            "code_b": ["return y;"],
+        }
+    ]
+    vectors_a = np.array([[1.0, 0.0], [0.6, 0.8]], dtype=np.float32)
+    vectors_b = np.array([[0.6, 0.8]], dtype=np.float32)
+
+    enriched = combined.enrich_similar_structures(
+        code_a, code_b, structures, line_vectors={0: (vectors_a, vectors_b)}
+    )
+
+    (structure,) = enriched
+    assert structure["overall_similarity"] == pytest.approx(0.9)
+    assert [pos["line_number"] for pos in structure["positions_a"]] == [0, 1]
+    assert [pos["line_number"] for pos in structure["positions_b"]] == [2]
+
+    expected = combined._transform_similarity(
+        np.array([[0.6], [1.0]], dtype=np.float32)
+    )
+    similarities = [
+        [cell["similarity"] for cell in row] for row in structure["line_similarities"]
+    ]
+    np.testing.assert_allclose(similarities, expected, rtol=1e-6)
+    assert similarities[1][0] == pytest.approx(1.0)
+
+
+def test_enrich_similar_structures_without_matching_lines(combined):
+    structures = [
+        {
+            "cluster_id": 3,
+            "type": "Other Code Structure",
+            "similarity": 0.5,
+            "code_a": ["missing();"],
+            "code_b": ["absent();"],
+        }
+    ]
+    empty = np.zeros((0, 2), dtype=np.float32)
+
+    (structure,) = combined.enrich_similar_structures(
+        "a();", "b();", structures, line_vectors={3: (empty, empty)}
+    )
+
+    assert structure["positions_a"] == []
+    assert structure["positions_b"] == []
+    assert structure["line_similarities"] == []